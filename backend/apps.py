@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backend'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        from .search import ensure_search_indexes
+
+        post_migrate.connect(ensure_search_indexes, sender=self)
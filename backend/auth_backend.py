@@ -1,17 +1,42 @@
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied
+
+from .throttling import (
+    client_ip, is_unknown_email, login_throttled, register_failure, remember_unknown_email, reset_failures,
+)
 
 User = get_user_model()
 
+
+def find_user(email):
+    """
+    Пользователь по email без учёта регистра и пробелов. Email хранится
+    нормализованным (UserManager.normalize_email), поэтому поиск идёт
+    точным совпадением по уникальному индексу.
+    """
+    return User.objects.filter(email=User.objects.normalize_email(email)).first()
+
 class EmailBackend(ModelBackend):
     def authenticate(self, request, username=None, password=None, **kwargs):
         email = kwargs.get('email') or username
         if not email or not password:
             return None
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
+        ip = client_ip(request)
+        # при исчерпанном лимите пароль не проверяется, а остальные бэкенды не опрашиваются
+        if login_throttled(email, ip):
+            raise PermissionDenied
+        if is_unknown_email(email):
+            register_failure(email, ip)
+            return None
+        user = find_user(email)
+        if user is None:
+            remember_unknown_email(email)
+            register_failure(email, ip)
             return None
+        # check_password пересчитывает хеш, если изменились алгоритм или число итераций
         if user.check_password(password) and self.user_can_authenticate(user):
+            reset_failures(email)
             return user
-        return None
\ No newline at end of file
+        register_failure(email, ip)
+        return None
@@ -0,0 +1,59 @@
+"""Аутентификация по токену с кэшем token -> пользователь"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+TOKEN_CACHE_KEY = "auth:token:{}"
+
+
+def get_auth_cache():
+    return caches[getattr(settings, "AUTH_TOKEN_CACHE", "default")]
+
+
+def token_cache_key(key):
+    # в ключе кэша не храним сам токен
+    return TOKEN_CACHE_KEY.format(hashlib.sha256(key.encode()).hexdigest())
+
+
+def forget_tokens(keys):
+    """Удаляет токены из кэша сразу и ещё раз после коммита"""
+    cache_keys = [token_cache_key(key) for key in keys]
+    if not cache_keys:
+        return
+    cache = get_auth_cache()
+    cache.delete_many(cache_keys)
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication, который хранит пару (пользователь, токен) в кэше
+    AUTH_TOKEN_CACHE на AUTH_TOKEN_CACHE_TIMEOUT секунд, поэтому
+    повторные запросы с тем же токеном не ходят в базу.
+
+    Запись удаляется при удалении токена и при сохранении пользователя
+    (см. backend/signals.py).
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_auth_cache()
+        cache_key = token_cache_key(key)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        model = self.get_model()
+        try:
+            token = model.objects.select_related("user").get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+
+        cache.set(cache_key, (token.user, token), getattr(settings, "AUTH_TOKEN_CACHE_TIMEOUT", 60))
+        return token.user, token
@@ -0,0 +1,111 @@
+"""Операции с корзиной покупателя"""
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+
+from .models import Order, OrderItem, ProductInfo
+
+# Сколько раз повторить поиск корзины, если параллельный запрос создал или оформил её
+CART_ATTEMPTS = 3
+
+
+def find_cart_id(user):
+    """id корзины пользователя: точечный запрос по индексу one_cart_per_user"""
+    return Order.objects.filter(user=user, state=Order.States.CART).values_list("id", flat=True).first()
+
+
+def get_or_create_cart_id(user):
+    """
+    id корзины пользователя, при необходимости новой. Если корзину
+    одновременно создаёт параллельный запрос, один из INSERT упадёт на
+    one_cart_per_user, и проигравший возьмёт уже созданную корзину.
+    """
+    for attempt in range(CART_ATTEMPTS):
+        cart_id = find_cart_id(user)
+        if cart_id is not None:
+            return cart_id
+        try:
+            with transaction.atomic():
+                return Order.objects.create(user=user, state=Order.States.CART).id
+        except IntegrityError:
+            if attempt == CART_ATTEMPTS - 1:
+                raise
+
+
+def request_cart_id(request, create=False):
+    """id корзины пользователя запроса; запоминается до конца запроса"""
+    cart_id = getattr(request, "_cart_id", None)
+    if cart_id is None:
+        cart_id = get_or_create_cart_id(request.user) if create else find_cart_id(request.user)
+        request._cart_id = cart_id
+    return cart_id
+
+
+def lock_cart(user, cart_id=None):
+    """
+    Блокирует строку корзины до конца транзакции и возвращает её id:
+    параллельные запросы одного покупателя идут по очереди. Если корзину
+    успели оформить, берётся новая.
+    """
+    for _ in range(CART_ATTEMPTS):
+        cart_id = cart_id or get_or_create_cart_id(user)
+        locked = Order.objects.select_for_update().filter(id=cart_id, state=Order.States.CART)
+        if locked.values_list("id", flat=True):
+            return cart_id
+        cart_id = None
+    raise Order.DoesNotExist("Не удалось получить корзину")
+
+
+def parse_items(items):
+    """[{'product_info': id, 'quantity': n}, ...] -> {id: n}; повторы одного товара суммируются"""
+    if not isinstance(items, list) or not items:
+        raise ValueError("Не указаны товары")
+
+    quantities = {}
+    for item in items:
+        try:
+            product_info_id = int(item["product_info"])
+            quantity = int(item.get("quantity", 1))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            raise ValueError("Позиция должна содержать product_info и quantity")
+        if quantity < 1:
+            raise ValueError("Количество должно быть положительным")
+        quantities[product_info_id] = quantities.get(product_info_id, 0) + quantity
+    return quantities
+
+
+@transaction.atomic
+def add_to_basket(user, quantities, cart_id=None):
+    """
+    Добавляет товары {product_info_id: quantity} в корзину пользователя.
+
+    Товары проверяются одним запросом id__in, уже лежащие в корзине строки
+    увеличиваются одним UPDATE quantity = quantity + n, новые вставляются
+    одним INSERT. cart_id - уже известный id корзины (request_cart_id).
+    Возвращает (создано, обновлено); при неизвестных товарах бросает
+    ProductInfo.DoesNotExist и ничего не меняет.
+    """
+    found = set(ProductInfo.objects.filter(id__in=quantities).values_list("id", flat=True))
+    missing = sorted(set(quantities) - found)
+    if missing:
+        raise ProductInfo.DoesNotExist(f"Товары не найдены: {', '.join(map(str, missing))}")
+
+    cart_id = lock_cart(user, cart_id)
+
+    existing = set(
+        OrderItem.objects.filter(order_id=cart_id, product_info_id__in=quantities)
+        .values_list("product_info_id", flat=True)
+    )
+    if existing:
+        OrderItem.objects.filter(order_id=cart_id, product_info_id__in=existing).update(
+            quantity=F("quantity") + Case(
+                *[When(product_info_id=pk, then=Value(quantities[pk])) for pk in existing],
+                output_field=PositiveIntegerField(),
+            )
+        )
+
+    created = [
+        OrderItem(order_id=cart_id, product_info_id=pk, quantity=quantity)
+        for pk, quantity in quantities.items() if pk not in existing
+    ]
+    OrderItem.objects.bulk_create(created)
+    return len(created), len(existing)
@@ -0,0 +1,76 @@
+"""
+Кэш ответов каталога с версиями, которые сбрасываются импортом и сигналами.
+
+Версии меняет тот процесс, который изменил данные (веб-запрос, воркер
+Celery, команда импорта), поэтому CATALOG_CACHE должен быть общим для всех
+процессов (Redis, Memcached). С LocMemCache другие процессы продолжат
+отдавать старые страницы; manage.py check --deploy такой кэш не пропускает.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+CATALOG_VERSION_KEY = "catalog:version"
+SHOP_VERSION_KEY = "catalog:version:shop:{}"
+
+
+def get_catalog_cache():
+    return caches[getattr(settings, "CATALOG_CACHE", "default")]
+
+
+def new_version():
+    # Версия из часов, а не счётчик: после вытеснения ключа из кэша
+    # новая версия не совпадёт ни с одной из прежних
+    return time.time_ns()
+
+
+def get_version(key):
+    cache = get_catalog_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, new_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_catalog_version(shop_ids=()):
+    """
+    Делает недействительными закэшированные страницы каталога
+    (всего и перечисленных магазинов).
+
+    Версия меняется сразу и ещё раз после коммита: запрос, который взял
+    ключ страницы после первой смены, но прочитал базу до коммита, сохранит
+    старые цены под промежуточной версией, и вторая смена её отбросит.
+    """
+    keys = [CATALOG_VERSION_KEY, *(SHOP_VERSION_KEY.format(shop_id) for shop_id in set(shop_ids))]
+
+    def bump():
+        get_catalog_cache().set_many({key: new_version() for key in keys}, timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def catalog_cache_key(request):
+    """Ключ страницы каталога: версия магазина (или всего каталога) + полный URL"""
+    shop = request.query_params.get("shop", "")
+    version_key = SHOP_VERSION_KEY.format(shop) if shop.isdigit() else CATALOG_VERSION_KEY
+    url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f"catalog:page:{get_version(version_key)}:{url}"
+
+
+def get_cached_page(key):
+    return get_catalog_cache().get(key)
+
+
+def set_cached_page(key, data):
+    """
+    Сохраняет страницу под ключом, вычисленным в начале запроса, до чтения
+    базы: если импорт сменил версию, пока запрос читал данные, страница
+    ляжет под старую версию, которую уже никто не прочитает.
+    """
+    timeout = getattr(settings, "CATALOG_CACHE_TIMEOUT", 300)
+    get_catalog_cache().set(key, data, timeout=timeout)
@@ -0,0 +1,110 @@
+"""
+Поддержка денормализованного каталога CatalogEntry.
+
+Каждая запись - это ProductInfo вместе с названием продукта, магазином,
+категорией и характеристиками, чтобы каталог читался из одной таблицы.
+"""
+from collections import defaultdict
+
+from django.db.models import F
+
+from .models import CatalogEntry, ProductInfo, ProductParameter
+from .search import update_search_vectors
+
+CHUNK_SIZE = 1000
+
+# Поля записи, которые пересобираются из нормализованных таблиц
+ENTRY_FIELDS = [
+    "shop", "category", "name", "shop_name", "model", "quantity", "price", "parameters", "parameters_text",
+]
+
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def build_entries(product_info_ids):
+    """Собирает записи каталога по нормализованным таблицам (два запроса)"""
+    parameters = defaultdict(dict)
+    # порядок задан явно: иначе parameters_text зависел бы от плана запроса,
+    # и check_catalog считал бы одинаковые записи устаревшими
+    for info_id, name, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).order_by('product_info_id', 'parameter__name').values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        parameters[info_id][name] = value
+
+    rows = ProductInfo.objects.filter(id__in=product_info_ids).values(
+        'id', 'shop_id', 'model', 'quantity', 'price',
+        name=F('product__name'), category_id=F('product__category_id'), shop_name=F('shop__name'),
+    )
+    return [
+        CatalogEntry(
+            product_info_id=row['id'],
+            shop_id=row['shop_id'],
+            category_id=row['category_id'],
+            name=row['name'],
+            shop_name=row['shop_name'],
+            model=row['model'],
+            quantity=row['quantity'],
+            price=row['price'],
+            parameters=parameters[row['id']],
+            parameters_text=" ".join(parameters[row['id']].values()),
+        )
+        for row in rows
+    ]
+
+
+def refresh_catalog_entries(product_info_ids):
+    """Пересобирает записи каталога для указанных товаров"""
+    for ids in chunked(set(product_info_ids)):
+        entries = build_entries(ids)
+        if entries:
+            CatalogEntry.objects.bulk_create(
+                entries,
+                update_conflicts=True,
+                unique_fields=['product_info'],
+                update_fields=ENTRY_FIELDS,
+            )
+            update_search_vectors(ids)
+        gone = set(ids) - {entry.product_info_id for entry in entries}
+        if gone:
+            CatalogEntry.objects.filter(product_info_id__in=gone).delete()
+
+
+def rebuild_catalog():
+    """Полностью пересобирает каталог; возвращает число записей"""
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    refresh_catalog_entries(ids)
+    CatalogEntry.objects.exclude(product_info_id__in=ProductInfo.objects.values('id')).delete()
+    return len(ids)
+
+
+def entry_values(entry):
+    return [getattr(entry, field + '_id' if field in ('shop', 'category') else field) for field in ENTRY_FIELDS]
+
+
+def check_catalog():
+    """
+    Сверяет каталог с нормализованными таблицами.
+
+    Возвращает словарь {'missing': [...], 'extra': [...], 'stale': [...]}
+    с id товаров (ProductInfo), для которых записи нет, которые удалены
+    или отличаются от исходных данных.
+    """
+    problems = {'missing': [], 'extra': [], 'stale': []}
+    ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    for chunk in chunked(ids):
+        stored = CatalogEntry.objects.in_bulk(chunk)
+        for expected in build_entries(chunk):
+            entry = stored.get(expected.product_info_id)
+            if entry is None:
+                problems['missing'].append(expected.product_info_id)
+            elif entry_values(entry) != entry_values(expected):
+                problems['stale'].append(expected.product_info_id)
+    problems['extra'] = list(
+        CatalogEntry.objects.exclude(product_info_id__in=ProductInfo.objects.values('id'))
+        .values_list('product_info_id', flat=True)
+    )
+    return problems
@@ -0,0 +1,62 @@
+"""Оформление заказа из корзины"""
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+
+from .inventory import reserve_stock
+from .mail import queue_email
+from .models import MONEY, Order, OrderItem, ProductInfo
+from .transitions import record_transitions
+
+
+class EmptyBasket(Exception):
+    pass
+
+
+def snapshot_orders(order_ids):
+    """
+    Фиксирует в строках заказов цену, название товара и магазина, а в
+    заказах - итоговую сумму. Два UPDATE на любое число заказов.
+    """
+    info = ProductInfo.objects.filter(id=OuterRef("product_info_id"))
+    OrderItem.objects.filter(order_id__in=order_ids).update(
+        price=Subquery(info.values("price")[:1]),
+        product_name=Subquery(info.values("product__name")[:1]),
+        shop_name=Subquery(info.values("shop__name")[:1]),
+    )
+    totals = OrderItem.objects.filter(order_id=OuterRef("pk")).values("order_id").annotate(
+        total=Sum(F("quantity") * F("price"), output_field=MONEY)
+    ).values("total")
+    Order.objects.filter(id__in=order_ids).update(total_amount=Subquery(totals[:1], output_field=MONEY))
+
+
+@transaction.atomic
+def confirm_order(user, contact):
+    """
+    Переводит корзину пользователя в новый заказ с адресом contact.
+
+    Остатки всех позиций списываются атомарно (см. backend.inventory);
+    при нехватке бросается OutOfStock и корзина остаётся корзиной.
+    Цены и названия строк фиксируются в заказе (snapshot_orders),
+    письмо покупателю ставится в очередь в той же транзакции.
+    """
+    order = Order.objects.select_for_update().filter(user=user, state=Order.States.CART).first()
+    if not order:
+        raise EmptyBasket
+    lines = dict(OrderItem.objects.filter(order=order).values_list("product_info_id", "quantity"))
+    if not lines:
+        raise EmptyBasket
+
+    reserve_stock(lines)
+    snapshot_orders([order.id])
+    order.refresh_from_db(fields=["total_amount"])
+
+    order.contact = contact
+    order.state = Order.States.NEW
+    order.save(update_fields=["contact", "state"])
+    record_transitions([(order.id, Order.States.CART, Order.States.NEW)], user)
+    queue_email(
+        subject=f"Заказ №{order.id} оформлен",
+        body=f"Ваш заказ №{order.id} на сумму {order.total_amount} принят в обработку.",
+        to=[user.email],
+    )
+    return order
@@ -0,0 +1,31 @@
+"""Проверки настроек для manage.py check --deploy"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Кэши, которые живут внутри процесса и не видны другим воркерам
+LOCAL_CACHE_BACKENDS = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def shared_caches():
+    """Кэши, которые должны быть общими для всех процессов: (алиас, что в нём хранится)"""
+    return [
+        ("default", "прогресс импорта прайсов"),
+        (getattr(settings, "CATALOG_CACHE", "default"), "версии каталога"),
+    ]
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    errors = []
+    for alias, purpose in shared_caches():
+        backend = settings.CACHES.get(alias, {}).get("BACKEND")
+        if backend in LOCAL_CACHE_BACKENDS:
+            errors.append(Error(
+                f"Кэш '{alias}' ({backend}) не общий для процессов, а в нём хранится {purpose}",
+                hint="Укажите REDIS_URL или другой общий бэкенд кэша в CACHES",
+                id="backend.E001",
+            ))
+    return errors
@@ -0,0 +1,124 @@
+"""
+Фасетный поиск по характеристикам товаров.
+
+Счётчики по категориям хранятся в ParameterFacet и пересчитываются при
+импорте и изменении характеристик; при фильтре по характеристикам
+счётчики считаются по индексу param_value_idx только для подходящих товаров.
+"""
+import re
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from .models import Category, ParameterFacet, ProductParameter
+
+PARAM_QUERY_RE = re.compile(r'^param\[(.+)\]$')
+
+
+def parse_param_filters(params):
+    """?param[Цвет]=черный&param[Цвет]=белый -> {'Цвет': ['черный', 'белый']}"""
+    selected = {}
+    for key in params:
+        match = PARAM_QUERY_RE.match(key)
+        if match:
+            values = [value for value in params.getlist(key) if value]
+            if values:
+                selected[match.group(1)] = values
+    return selected
+
+
+def filter_by_params(queryset, selected, exclude=None):
+    """Оставляет товары со всеми выбранными значениями (внутри характеристики - любое из)"""
+    for name, values in selected.items():
+        if name == exclude:
+            continue
+        queryset = queryset.filter(pk__in=ProductParameter.objects.filter(
+            parameter__name=name, value__in=values).values('product_info_id'))
+    return queryset
+
+
+def refresh_facets(category_ids):
+    """
+    Пересчитывает счётчики значений характеристик для категорий.
+
+    Счётчики обновляются на месте (INSERT ... ON CONFLICT) и удаляются только
+    пропавшие значения: параллельные пересчёты одной категории не упираются
+    в уникальность, а читатели не видят категорию без фасетов.
+    """
+    category_ids = set(category_ids)
+    if not category_ids:
+        return
+    with transaction.atomic():
+        _refresh_facets(category_ids)
+
+
+def _refresh_facets(category_ids):
+    # пересчёты одной категории идут по очереди: иначе счётчики, посчитанные
+    # до коммита параллельного импорта, перезапишут более новые
+    list(Category.objects.select_for_update(no_key=True).filter(id__in=category_ids).order_by('id').values_list(
+        'id', flat=True))
+    rows = ProductParameter.objects.filter(
+        product_info__product__category_id__in=category_ids
+    ).values('product_info__product__category_id', 'parameter_id', 'value').annotate(
+        count=Count('id')
+    ).order_by('product_info__product__category_id', 'parameter_id', 'value')
+    # строки блокируются в порядке ключа: параллельные импорты ждут друг друга, а не взаимно
+    facets = [
+        ParameterFacet(
+            category_id=row['product_info__product__category_id'],
+            parameter_id=row['parameter_id'],
+            value=row['value'],
+            count=row['count'],
+        )
+        for row in rows
+    ]
+
+    ParameterFacet.objects.bulk_create(
+        facets,
+        update_conflicts=True,
+        unique_fields=['category', 'parameter', 'value'],
+        update_fields=['count'],
+    )
+    current = {(facet.category_id, facet.parameter_id, facet.value) for facet in facets}
+    stale = [
+        pk for pk, *key in ParameterFacet.objects.filter(category_id__in=category_ids).values_list(
+            'pk', 'category_id', 'parameter_id', 'value')
+        if tuple(key) not in current
+    ]
+    if stale:
+        ParameterFacet.objects.filter(pk__in=stale).delete()
+
+
+def group_counts(rows):
+    facets = defaultdict(dict)
+    for name, value, count in rows:
+        facets[name][value] = count
+    return facets
+
+
+def stored_facets(category_id=None):
+    """Счётчики из ParameterFacet: по категории или по всему каталогу"""
+    facets = ParameterFacet.objects.all()
+    if category_id is not None:
+        return group_counts(facets.filter(category_id=category_id).values_list('parameter__name', 'value', 'count'))
+    return group_counts(facets.values('parameter__name', 'value').annotate(
+        total=Sum('count')).values_list('parameter__name', 'value', 'total'))
+
+
+def live_facets(queryset, selected):
+    """
+    Счётчики для отфильтрованной выборки. Для выбранной характеристики
+    её собственный фильтр не применяется, чтобы остальные значения
+    оставались видны вместе с числом товаров.
+    """
+    def count(entries):
+        return group_counts(ProductParameter.objects.filter(
+            product_info_id__in=entries.values('pk')
+        ).values('parameter__name', 'value').annotate(total=Count('id')).values_list(
+            'parameter__name', 'value', 'total'))
+
+    facets = count(filter_by_params(queryset, selected))
+    for name in selected:
+        facets[name] = count(filter_by_params(queryset, selected, exclude=name)).get(name, {})
+    return facets
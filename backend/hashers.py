@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2 с числом итераций из PASSWORD_PBKDF2_ITERATIONS.
+
+    Алгоритм тот же (pbkdf2_sha256), поэтому существующие хеши проверяются
+    без изменений, а при входе пересчитываются под новое число итераций.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, "PASSWORD_PBKDF2_ITERATIONS", PBKDF2PasswordHasher.iterations)
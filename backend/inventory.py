@@ -0,0 +1,99 @@
+"""Резервирование остатков при оформлении заказа"""
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Sum, Value, When
+
+from .cache import bump_catalog_version
+from .catalog import refresh_catalog_entries
+from .models import OrderItem, ProductInfo
+
+# Сколько раз повторить списание, если остатки изменились между чтением и UPDATE
+RESERVE_ATTEMPTS = 3
+
+
+class OutOfStock(Exception):
+    """Не хватает остатков; shortages - список {product_info, requested, available}"""
+
+    def __init__(self, shortages):
+        super().__init__("Недостаточно товара на складе")
+        self.shortages = shortages
+
+
+class StockChanged(Exception):
+    pass
+
+
+def find_shortages(lines, available):
+    return [
+        {"product_info": pk, "requested": quantity, "available": available.get(pk, 0)}
+        for pk, quantity in sorted(lines.items())
+        if available.get(pk, 0) < quantity
+    ]
+
+
+def sync_catalog(product_info_ids):
+    """Переносит новые остатки в каталог и сбрасывает кэш страниц магазинов"""
+    refresh_catalog_entries(product_info_ids)
+    bump_catalog_version(
+        ProductInfo.objects.filter(id__in=product_info_ids).values_list("shop_id", flat=True).distinct()
+    )
+
+
+def _reserve(lines):
+    ids = sorted(lines)
+    # Строки блокируются в порядке id: два заказа не возьмут блокировки навстречу друг другу
+    available = dict(
+        ProductInfo.objects.select_for_update().filter(id__in=ids).order_by("id").values_list("id", "quantity")
+    )
+    shortages = find_shortages(lines, available)
+    if shortages:
+        raise OutOfStock(shortages)
+
+    # Одно условное списание по всем строкам: UPDATE ... WHERE quantity >= n
+    condition = Q()
+    for pk, quantity in lines.items():
+        condition |= Q(id=pk, quantity__gte=quantity)
+    updated = ProductInfo.objects.filter(condition).update(
+        quantity=F("quantity") - Case(
+            *[When(id=pk, then=Value(quantity)) for pk, quantity in lines.items()],
+            output_field=PositiveIntegerField(),
+        )
+    )
+    if updated != len(lines):
+        # возможно только на СУБД без блокировок строк: откатываем частичное списание
+        raise StockChanged
+    sync_catalog(ids)
+
+
+def reserve_stock(lines):
+    """
+    Списывает остатки {product_info_id: quantity} для всех строк заказа
+    или не списывает ничего и бросает OutOfStock со списком нехватки.
+    """
+    for _ in range(RESERVE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _reserve(lines)
+            return
+        except StockChanged:
+            continue
+
+    available = dict(ProductInfo.objects.filter(id__in=lines).values_list("id", "quantity"))
+    raise OutOfStock(find_shortages(lines, available))
+
+
+def release_stock(order_ids):
+    """Возвращает на склад товары отменённых заказов одним UPDATE"""
+    lines = dict(
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values("product_info_id").annotate(total=Sum("quantity"))
+        .values_list("product_info_id", "total")
+    )
+    if not lines:
+        return
+    ProductInfo.objects.filter(id__in=lines).update(
+        quantity=F("quantity") + Case(
+            *[When(id=pk, then=Value(quantity)) for pk, quantity in lines.items()],
+            output_field=PositiveIntegerField(),
+        )
+    )
+    sync_catalog(lines)
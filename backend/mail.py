@@ -0,0 +1,123 @@
+"""
+Очередь исходящих писем.
+
+Письмо сохраняется в таблицу OutgoingEmail в той же транзакции, что и
+изменение, о котором оно сообщает, а отправляет его Celery-задача
+send_outbox: пачками, через одно SMTP-соединение, с повторами и
+растущей паузой между попытками. Запрос не ждёт почтовый сервер.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+
+
+def queue_email(subject, body, to, from_email=None):
+    """Ставит письмо в очередь; отправка начнётся после коммита транзакции"""
+    email = OutgoingEmail.objects.create(
+        subject=subject, body=body, to=list(to), from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+    )
+    transaction.on_commit(wake_outbox)
+    return email
+
+
+def wake_outbox():
+    """Будит воркер; если брокер недоступен, письмо отправит периодический запуск"""
+    from .tasks import send_outbox
+
+    try:
+        send_outbox.apply_async(retry=False)
+    except Exception:
+        logger.warning("Не удалось поставить send_outbox в очередь", exc_info=True)
+
+
+def retry_delay(attempts):
+    base = getattr(settings, "EMAIL_OUTBOX_RETRY_DELAY", 60)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def register_failure(email, error, max_attempts):
+    """Засчитывает неудачную попытку: следующая через растущую паузу или отказ"""
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.state = OutgoingEmail.States.FAILED
+    else:
+        email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+
+
+def deliver_batch(batch_size=BATCH_SIZE):
+    """
+    Отправляет одну пачку писем, срок которых подошёл, и возвращает
+    (отправлено, с ошибкой). Строки пачки заблокированы до конца
+    отправки; параллельные воркеры их пропускают (SKIP LOCKED).
+    """
+    max_attempts = getattr(settings, "EMAIL_OUTBOX_MAX_ATTEMPTS", 5)
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(state=OutgoingEmail.States.PENDING, next_attempt_at__lte=timezone.now())
+            .order_by("next_attempt_at", "id")[:batch_size]
+        )
+        if not emails:
+            return 0, 0
+
+        sent = failed = 0
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as error:
+            # сервер недоступен: попытка и пауза засчитываются всей пачке,
+            # иначе те же письма забирались бы снова при каждом запуске
+            logger.warning("Не удалось открыть соединение с почтовым сервером", exc_info=True)
+            for email in emails:
+                register_failure(email, error, max_attempts)
+            failed = len(emails)
+        else:
+            try:
+                for email in emails:
+                    message = EmailMessage(
+                        email.subject, email.body, email.from_email or None, email.to, connection=connection,
+                    )
+                    try:
+                        message.send()
+                    except Exception as error:
+                        failed += 1
+                        register_failure(email, error, max_attempts)
+                    else:
+                        sent += 1
+                        email.attempts += 1
+                        email.state = OutgoingEmail.States.SENT
+                        email.sent_at = timezone.now()
+            finally:
+                # письма уже ушли: ошибка при закрытии не должна откатить их учёт
+                try:
+                    connection.close()
+                except Exception:
+                    logger.warning("Не удалось закрыть соединение с почтовым сервером", exc_info=True)
+
+        OutgoingEmail.objects.bulk_update(
+            emails, ["state", "attempts", "next_attempt_at", "last_error", "sent_at"]
+        )
+    return sent, failed
+
+
+def deliver_outbox(batch_size=BATCH_SIZE, max_batches=20):
+    """Отправляет пачки, пока очередь не опустеет (не больше max_batches)"""
+    total_sent = total_failed = 0
+    for _ in range(max_batches):
+        sent, failed = deliver_batch(batch_size)
+        total_sent += sent
+        total_failed += failed
+        if sent + failed < batch_size:
+            break
+    return total_sent, total_failed
@@ -0,0 +1,201 @@
+import json
+import platform
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import get_resolver
+from rest_framework.authtoken.models import Token
+
+from backend.cache import get_catalog_cache
+from backend.management.commands.generate_benchmark_data import BENCH_DOMAIN, BENCH_PASSWORD
+from backend.middleware import QueryStats
+from backend.models import CatalogEntry, Contact, ImportJob, Order, OrderItem, ProductInfo, User
+
+# Маршруты, которые не имеют смысла гонять в цикле
+SKIPPED = {
+    "admin": "админка Django",
+    None: "редирект на /products/",
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет запросы в секунду, p50/p99 и число SQL-запросов для каждого маршрута "
+        "orders/urls.py на данных generate_benchmark_data. Запросы на запись выполняются "
+        "в откатываемой транзакции, поэтому данные между прогонами не меняются."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Запросов на маршрут")
+        parser.add_argument("--warmup", type=int, default=10, help="Прогревочных запросов на маршрут")
+        parser.add_argument("--routes", nargs="*", help="Имена маршрутов (по умолчанию все)")
+        parser.add_argument("--cold", action="store_true", help="Сбрасывать кэш каталога перед каждым запросом")
+        parser.add_argument("--output", help="Куда сохранить результаты в JSON")
+        parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+
+    def handle(self, *args, **options):
+        scenarios = self.scenarios()
+        names = options["routes"] or [
+            getattr(pattern, "name", None) or getattr(pattern, "namespace", None)
+            for pattern in get_resolver().url_patterns
+        ]
+
+        results = {}
+        for name in names:
+            if name in SKIPPED or name not in scenarios:
+                reason = SKIPPED.get(name, "нет сценария")
+                results[name or "/"] = {"skipped": reason}
+                continue
+            results[name] = self.run(scenarios[name], options)
+            self.stdout.write(self.format_row(name, results[name]))
+
+        report = {"meta": self.meta(options), "routes": results}
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+            self.stdout.write(self.style.SUCCESS(f"Результаты сохранены в {options['output']}"))
+        if options["compare"]:
+            self.compare(json.loads(Path(options["compare"]).read_text(encoding="utf-8")), report)
+
+    def scenarios(self):
+        """Маршрут -> (клиент, метод, путь, данные)"""
+        buyer = User.objects.filter(email=f"buyer0@{BENCH_DOMAIN}").first()
+        partner = User.objects.filter(email=f"partner0@{BENCH_DOMAIN}").first()
+        if buyer is None or partner is None:
+            raise CommandError("Нет данных для бенчмарка: сначала запустите generate_benchmark_data")
+
+        buyer_client = self.client_for(buyer)
+        partner_client = self.client_for(partner)
+        anonymous = self.make_client()
+
+        info = ProductInfo.objects.filter(quantity__gt=0).order_by("id").first()
+        category_id = CatalogEntry.objects.values_list("category_id", flat=True).first()
+        contact = Contact.objects.filter(user=buyer).first()
+        cart_item = OrderItem.objects.filter(order__user=buyer, order__state=Order.States.CART).first()
+        partner_orders = list(
+            Order.objects.filter(items__product_info__shop__user=partner, state=Order.States.NEW)
+            .values_list("id", flat=True)[:100]
+        )
+        job, _ = ImportJob.objects.get_or_create(user=partner, url="https://example.com/bench.yaml")
+
+        return {
+            "register": (anonymous, "post", "/register/", {"email": "new@bench.local", "password": BENCH_PASSWORD}),
+            "login": (anonymous, "post", "/login/", {"email": buyer.email, "password": BENCH_PASSWORD}),
+            "product-list": (anonymous, "get", "/products/", {"category": category_id, "ordering": "price"}),
+            "product-facets": (anonymous, "get", "/products/facets/", {"category": category_id}),
+            "product-search": (anonymous, "get", "/products/search/", {"q": "Товар 1"}),
+            "basket": (buyer_client, "get", "/basket/", None),
+            "basket-add": (buyer_client, "post", "/basket/add/", {"product_info": info.id, "quantity": 1}),
+            "basket-batch": (buyer_client, "post", "/basket/batch/", {
+                "items": [{"product_info": pk, "quantity": 1} for pk in
+                          ProductInfo.objects.order_by("id").values_list("id", flat=True)[:20]]
+            }),
+            "basket-remove": (buyer_client, "post", "/basket/remove/", {"order_item_id": cart_item.id if cart_item else 0}),
+            "contacts": (buyer_client, "get", "/contacts/", None),
+            "contacts-add": (buyer_client, "post", "/contacts/add/", {
+                "city": "Москва", "street": "Тверская", "house": "1", "phone": "+70000000000",
+            }),
+            "contacts-remove": (buyer_client, "delete", f"/contacts/remove/{contact.id if contact else 0}/", None),
+            "confirm-order": (buyer_client, "post", "/order/confirm/", {"contact_id": contact.id if contact else 0}),
+            "order-list": (buyer_client, "get", "/orders/", None),
+            "partner-update": (partner_client, "post", "/partner/update/", {"url": "https://example.com/bench.yaml"}),
+            "partner-update-status": (partner_client, "get", f"/partner/update/{job.id}/", None),
+            "partner-orders": (partner_client, "get", "/partner/orders/", None),
+            "partner-order-state": (partner_client, "post", "/partner/orders/state/", {
+                "orders": partner_orders, "state": Order.States.CONFIRMED,
+            }),
+            "metrics": (anonymous, "get", "/metrics/", None),
+        }
+
+    @staticmethod
+    def make_client(**headers):
+        # хост должен пройти проверку ALLOWED_HOSTS; при пустом списке и DEBUG подходит localhost
+        hosts = [host.lstrip(".") for host in settings.ALLOWED_HOSTS if host != "*"]
+        return Client(HTTP_HOST=hosts[0] if hosts else "localhost", **headers)
+
+    def client_for(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        return self.make_client(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def request(self, scenario, cold):
+        client, method, path, data = scenario
+        if cold:
+            get_catalog_cache().clear()
+        stats = QueryStats()
+        started = time.perf_counter()
+        # запись откатывается: каждый запрос видит одни и те же данные
+        with transaction.atomic(), connection.execute_wrapper(stats):
+            if method == "get":
+                response = client.get(path, data)
+            else:
+                response = getattr(client, method)(path, data, content_type="application/json")
+            transaction.set_rollback(True)
+        return time.perf_counter() - started, stats.count, response.status_code
+
+    def run(self, scenario, options):
+        for _ in range(options["warmup"]):
+            self.request(scenario, options["cold"])
+
+        timings, queries, statuses = [], [], {}
+        started = time.perf_counter()
+        for _ in range(options["requests"]):
+            seconds, count, status = self.request(scenario, options["cold"])
+            timings.append(seconds)
+            queries.append(count)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        elapsed = time.perf_counter() - started
+
+        return {
+            "requests": len(timings),
+            "rps": round(len(timings) / elapsed, 1),
+            "p50_ms": round(percentile(timings, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(timings, 0.99) * 1000, 2),
+            "queries_avg": round(sum(queries) / len(queries), 1),
+            "queries_max": max(queries),
+            "statuses": statuses,
+        }
+
+    def meta(self, options):
+        return {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "database": connection.vendor,
+            "django": django.get_version(),
+            "python": platform.python_version(),
+            "requests_per_route": options["requests"],
+            "cold_cache": options["cold"],
+            "dataset": {
+                "products": ProductInfo.objects.count(),
+                "orders": Order.objects.exclude(state=Order.States.CART).count(),
+                "order_items": OrderItem.objects.count(),
+                "users": User.objects.count(),
+            },
+        }
+
+    @staticmethod
+    def format_row(name, result):
+        return (
+            f"{name:<24} {result['rps']:>9.1f} rps  p50 {result['p50_ms']:>8.2f} мс  "
+            f"p99 {result['p99_ms']:>8.2f} мс  SQL {result['queries_avg']:>5.1f}  {result['statuses']}"
+        )
+
+    def compare(self, old, new):
+        self.stdout.write(self.style.MIGRATE_HEADING("Сравнение с прошлым прогоном"))
+        for name, result in new["routes"].items():
+            before = old.get("routes", {}).get(name)
+            if "skipped" in result or not before or "skipped" in before:
+                continue
+            self.stdout.write(
+                f"{name:<24} rps {before['rps']:>9.1f} -> {result['rps']:>9.1f}  "
+                f"p99 {before['p99_ms']:>8.2f} -> {result['p99_ms']:>8.2f} мс  "
+                f"SQL {before['queries_avg']:>5.1f} -> {result['queries_avg']:>5.1f}"
+            )
@@ -0,0 +1,68 @@
+import time
+
+from django.contrib.auth.hashers import get_hasher, get_hashers
+from django.core.exceptions import PermissionDenied
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from backend.auth_backend import EmailBackend
+from backend.throttling import forget_attempts
+
+
+def rate(func, seconds):
+    """Число вызовов func в секунду на одном ядре"""
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+class Command(BaseCommand):
+    help = "Замеряет число проверок пароля и попыток входа в секунду на одно ядро"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seconds", type=float, default=2.0, help="Длительность каждого замера")
+
+    def handle(self, *args, **options):
+        seconds = options["seconds"]
+        row = "{:<45} {:>12}"
+        self.stdout.write(row.format("Сценарий", "в секунду"))
+
+        # Стоимость одной проверки пароля для каждого доступного хешера
+        for hasher in get_hashers():
+            try:
+                encoded = hasher.encode("bench-password", hasher.salt())
+            except ValueError:
+                # библиотека Argon2/bcrypt не установлена
+                continue
+            speed = rate(lambda: hasher.verify("wrong-password", encoded), seconds)
+            self.stdout.write(row.format(f"проверка пароля: {hasher.algorithm}", f"{speed:.1f}"))
+
+        # Попытки входа через EmailBackend: пароль не проверяется ни для неизвестного
+        # email (негативный кэш), ни после исчерпания лимита попыток
+        backend = EmailBackend()
+        ip = "203.0.113.1"
+        request = RequestFactory().post("/user/login/", REMOTE_ADDR=ip)
+        email = "nobody@bench.invalid"
+
+        def attempt():
+            try:
+                backend.authenticate(request, email=email, password="wrong-password")
+            except PermissionDenied:
+                pass
+
+        # Кэш общий с рабочими процессами: удаляются только ключи замера
+        forget_attempts(email, ip)
+        with override_settings(LOGIN_ATTEMPTS_PER_EMAIL=10 ** 9, LOGIN_ATTEMPTS_PER_IP=10 ** 9):
+            speed = rate(attempt, seconds)
+        self.stdout.write(row.format("вход: неизвестный email", f"{speed:.1f}"))
+        forget_attempts(email, ip)
+        speed = rate(attempt, seconds)
+        self.stdout.write(row.format("вход: лимит попыток исчерпан", f"{speed:.1f}"))
+        forget_attempts(email, ip)
+
+        self.stdout.write(f"Хешер по умолчанию: {get_hasher().algorithm}")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from backend.cache import bump_catalog_version
+from backend.catalog import check_catalog, refresh_catalog_entries
+
+
+class Command(BaseCommand):
+    help = "Сверяет каталог CatalogEntry с нормализованными таблицами"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Пересобрать расходящиеся записи")
+
+    def handle(self, *args, **options):
+        problems = check_catalog()
+        broken = [info_id for ids in problems.values() for info_id in ids]
+        if not broken:
+            self.stdout.write(self.style.SUCCESS("Каталог согласован"))
+            return
+
+        for kind, ids in problems.items():
+            if ids:
+                self.stdout.write(f"{kind}: {len(ids)} ({', '.join(map(str, ids[:20]))})")
+
+        if not options["fix"]:
+            raise CommandError(f"Каталог расходится с данными: {len(broken)} записей")
+
+        with transaction.atomic():
+            refresh_catalog_entries(broken)
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f"Исправлено записей: {len(broken)}"))
@@ -0,0 +1,79 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+
+from backend.models import CatalogEntry, Order, OrderItem, ProductInfo, Shop, User
+
+# Строки плана с индексом: SQLite (USING INDEX) и PostgreSQL (Index Scan using)
+INDEX_RE = re.compile(
+    r"(?:USING (?:COVERING )?INDEX|Index (?:Only )?Scan (?:Backward )?using|Bitmap Index Scan on) (\w+)"
+)
+PRIMARY_KEY_RE = re.compile(r"USING (?:INTEGER )?PRIMARY KEY")
+# Полный просмотр таблицы без индекса
+SCAN_RE = re.compile(r"(?:^|\s)SCAN (\w+)(?:\s*$)|Seq Scan on (\w+)", re.MULTILINE)
+
+
+def hot_queries(user_id, shop_id, category_id):
+    """Запросы горячих путей API в том виде, в каком их строят представления"""
+    shop_items = OrderItem.objects.filter(product_info__shop_id__in=[shop_id])
+    return {
+        "корзина (BasketView, BasketAddView, ConfirmOrderView)":
+            Order.objects.filter(user_id=user_id, state=Order.States.CART),
+        "история заказов (OrderListView)":
+            Order.objects.filter(user_id=user_id).exclude(state=Order.States.CART).order_by("-created_at", "-pk")[:20],
+        "импорт: отпечатки товаров магазина":
+            ProductInfo.objects.filter(shop_id=shop_id, external_id__in=[1, 2, 3]).values_list("external_id", "fingerprint"),
+        "каталог: категория по цене":
+            CatalogEntry.objects.filter(category_id=category_id).order_by("price", "pk")[:50],
+        "каталог: магазин по цене":
+            CatalogEntry.objects.filter(shop_id=shop_id).order_by("price", "pk")[:50],
+        "каталог: в наличии по цене":
+            CatalogEntry.objects.filter(quantity__gt=0).order_by("price", "pk")[:50],
+        "заказы партнёра (PartnerOrdersView)":
+            Order.objects.filter(Exists(shop_items.filter(order=OuterRef("pk"))))
+            .exclude(state=Order.States.CART).order_by("-created_at", "-pk")[:20],
+    }
+
+
+def plan_indexes(plan):
+    """Индексы из плана и таблицы, которые читаются целиком"""
+    indexes = INDEX_RE.findall(plan)
+    if PRIMARY_KEY_RE.search(plan):
+        indexes.append("primary key")
+    scans = [table for match in SCAN_RE.findall(plan) for table in match if table]
+    return indexes, scans
+
+
+class Command(BaseCommand):
+    help = "Выполняет EXPLAIN для горячих запросов API и показывает, какие индексы они используют"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="id покупателя (по умолчанию первый)")
+        parser.add_argument("--shop", type=int, help="id магазина (по умолчанию первый)")
+        parser.add_argument("--analyze", action="store_true", help="EXPLAIN ANALYZE (только PostgreSQL)")
+        parser.add_argument("--verbose-plans", action="store_true", help="Печатать планы целиком")
+        parser.add_argument(
+            "--fail-on-scan", action="store_true", help="Завершиться с ошибкой, если запрос читает таблицу целиком",
+        )
+
+    def handle(self, *args, **options):
+        user_id = options["user"] or User.objects.values_list("id", flat=True).first() or 0
+        shop_id = options["shop"] or Shop.objects.values_list("id", flat=True).first() or 0
+        category_id = CatalogEntry.objects.filter(shop_id=shop_id).values_list("category_id", flat=True).first() or 0
+        explain_options = {"analyze": True} if options["analyze"] else {}
+
+        without_index = []
+        for name, queryset in hot_queries(user_id, shop_id, category_id).items():
+            plan = queryset.explain(**explain_options)
+            indexes, scans = plan_indexes(plan)
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            if options["verbose_plans"]:
+                self.stdout.write(plan)
+            self.stdout.write(f"  индексы: {', '.join(dict.fromkeys(indexes)) or '-'}")
+            if scans:
+                without_index.append(name)
+                self.stdout.write(self.style.WARNING(f"  полный просмотр: {', '.join(dict.fromkeys(scans))}"))
+
+        if without_index and options["fail_on_scan"]:
+            raise CommandError(f"Запросы без индекса: {'; '.join(without_index)}")
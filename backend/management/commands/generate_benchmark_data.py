@@ -0,0 +1,137 @@
+import random
+from datetime import timedelta
+from pathlib import Path
+
+import yaml
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from backend.catalog import chunked
+from backend.checkout import snapshot_orders
+from backend.models import Contact, Order, OrderItem, ProductInfo, Shop, User
+from data.import_data import import_shop_from_yaml
+
+BENCH_DOMAIN = "bench.local"
+BENCH_PASSWORD = "bench-password"
+SHOP_NAME = "Бенчмарк-магазин {}"
+# id категорий не пересекаются с категориями из data/shop1.yaml
+FIRST_CATEGORY_ID = 10000
+
+HISTORY_STATES = [
+    Order.States.NEW, Order.States.CONFIRMED, Order.States.ASSEMBLED,
+    Order.States.SENT, Order.States.DELIVERED, Order.States.CANCELED,
+]
+
+
+def make_feed(rng, shop_number, skus, categories, parameters):
+    """Прайс в формате data/shop1.yaml; товары с одним номером есть во всех магазинах"""
+    goods = []
+    for sku in range(skus):
+        price = rng.randint(10, 2000) * 50
+        goods.append({
+            "id": 100000 + sku,
+            "category": FIRST_CATEGORY_ID + sku % categories,
+            "model": f"bench/{sku}",
+            "name": f"Товар {sku}",
+            "price": price,
+            "price_rrc": price + rng.randint(0, 20) * 50,
+            "quantity": rng.randint(0, 50),
+            "parameters": {
+                f"Параметр {n}": rng.choice([f"значение {v}" for v in range(8)] + [rng.randint(1, 512)])
+                for n in range(parameters)
+            },
+        })
+    return {
+        "shop": SHOP_NAME.format(shop_number),
+        "categories": [{"id": FIRST_CATEGORY_ID + n, "name": f"Категория {n}"} for n in range(categories)],
+        "goods": goods,
+    }
+
+
+class Command(BaseCommand):
+    help = "Создаёт синтетические прайсы, покупателей и историю заказов для бенчмарка API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shops", type=int, default=5)
+        parser.add_argument("--skus", type=int, default=2000, help="Товаров в каждом магазине")
+        parser.add_argument("--categories", type=int, default=20)
+        parser.add_argument("--parameters", type=int, default=5, help="Характеристик у товара")
+        parser.add_argument("--buyers", type=int, default=100)
+        parser.add_argument("--orders", type=int, default=5000, help="Оформленных заказов в истории")
+        parser.add_argument("--out", default="benchmark_data", help="Каталог для YAML-прайсов")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        out = Path(options["out"])
+        out.mkdir(parents=True, exist_ok=True)
+
+        for n in range(options["shops"]):
+            path = out / f"bench_shop_{n}.yaml"
+            feed = make_feed(rng, n, options["skus"], options["categories"], options["parameters"])
+            with open(path, "w", encoding="utf-8") as f:
+                yaml.safe_dump(feed, f, allow_unicode=True, sort_keys=False)
+            stats = import_shop_from_yaml(path)
+            self.stdout.write(f"{path}: товаров {stats['parsed']}")
+
+        with transaction.atomic():
+            self.create_users(rng, options)
+        self.stdout.write(self.style.SUCCESS("Данные для бенчмарка готовы"))
+
+    def create_users(self, rng, options):
+        # один хеш на всех: иначе создание пользователей упирается в PBKDF2
+        password = make_password(BENCH_PASSWORD)
+        shops = list(Shop.objects.filter(name__startswith=SHOP_NAME.format("")).order_by("id"))
+        for n, shop in enumerate(shops):
+            partner, _ = User.objects.get_or_create(
+                email=f"partner{n}@{BENCH_DOMAIN}",
+                defaults={"password": password, "type": User.Types.SHOP, "is_active": True},
+            )
+            shop.user = partner
+            shop.save(update_fields=["user"])
+
+        existing = set(User.objects.filter(email__endswith=f"@{BENCH_DOMAIN}").values_list("email", flat=True))
+        User.objects.bulk_create([
+            User(email=email, password=password, is_active=True)
+            for email in (f"buyer{n}@{BENCH_DOMAIN}" for n in range(options["buyers"]))
+            if email not in existing
+        ])
+        buyers = list(User.objects.filter(email__startswith="buyer", email__endswith=f"@{BENCH_DOMAIN}").order_by("id"))
+        with_contact = set(Contact.objects.filter(user__in=buyers).values_list("user_id", flat=True))
+        Contact.objects.bulk_create([
+            Contact(user=buyer, city="Москва", street=f"Улица {buyer.id}", house="1", phone="+70000000000")
+            for buyer in buyers if buyer.id not in with_contact
+        ])
+        contacts = dict(Contact.objects.filter(user__in=buyers).values_list("user_id", "id"))
+
+        info_ids = list(ProductInfo.objects.filter(shop__in=shops).values_list("id", flat=True))
+        now = timezone.now()
+        orders = Order.objects.bulk_create([
+            Order(user=buyer, contact_id=contacts[buyer.id], state=rng.choice(HISTORY_STATES))
+            for buyer in (rng.choice(buyers) for _ in range(options["orders"]))
+        ])
+        # auto_now_add проставляет текущее время: история растягивается на год назад
+        for order in orders:
+            order.created_at = now - timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        Order.objects.bulk_update(orders, ["created_at"], batch_size=1000)
+
+        items = [
+            OrderItem(order=order, product_info_id=pk, quantity=rng.randint(1, 3))
+            for order in orders
+            for pk in rng.sample(info_ids, min(len(info_ids), rng.randint(1, 5)))
+        ]
+        OrderItem.objects.bulk_create(items, batch_size=1000)
+        for chunk in chunked([order.id for order in orders], 1000):
+            snapshot_orders(chunk)
+
+        # у каждого покупателя корзина на несколько позиций
+        with_cart = set(Order.objects.filter(user__in=buyers, state=Order.States.CART).values_list("user_id", flat=True))
+        carts = Order.objects.bulk_create([Order(user=buyer) for buyer in buyers if buyer.id not in with_cart])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=cart, product_info_id=pk, quantity=1)
+            for cart in carts
+            for pk in rng.sample(info_ids, min(len(info_ids), 3))
+        ], batch_size=1000)
+        self.stdout.write(f"Покупателей: {len(buyers)}, заказов: {len(orders)}, строк: {len(items)}")
@@ -0,0 +1,99 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+from data.import_data import import_shop_from_yaml
+
+# Повторы импорта файла, если транзакцию откатила СУБД (взаимная блокировка, занятая база)
+IMPORT_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+
+def collect_files(patterns):
+    """Раскрывает каталоги и glob-шаблоны в список YAML-файлов"""
+    files = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            files.extend(sorted([*path.glob("*.yaml"), *path.glob("*.yml")]))
+        else:
+            files.extend(Path(name) for name in sorted(glob.glob(pattern)))
+    # один файл может попасть под несколько шаблонов
+    return list(dict.fromkeys(files))
+
+
+def init_worker():
+    # при запуске через spawn дочерний процесс стартует без настроенного Django
+    django.setup()
+
+
+def import_file(path, full=False):
+    """Импортирует один прайс в отдельной транзакции и замеряет время"""
+    started = time.perf_counter()
+    for attempt in range(1, IMPORT_ATTEMPTS + 1):
+        try:
+            stats = import_shop_from_yaml(path, full=full)
+        except OperationalError as error:
+            # транзакция откатилась целиком, поэтому файл можно импортировать заново
+            stats = {"shop": None, "error": str(error)}
+            if attempt < IMPORT_ATTEMPTS:
+                time.sleep(RETRY_DELAY * attempt)
+                continue
+        except Exception as error:
+            stats = {"shop": None, "error": str(error)}
+        break
+    stats["file"] = str(path)
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+class Command(BaseCommand):
+    help = "Параллельный импорт прайсов магазинов из каталога или по glob-шаблону"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Каталоги или шаблоны вида data/*.yaml")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1,
+            help="Число процессов (1 - импорт в текущем процессе)",
+        )
+        parser.add_argument("--full", action="store_true", help="Перезаписать все товары, а не только изменённые")
+
+    def handle(self, *args, **options):
+        files = collect_files(options["paths"])
+        if not files:
+            raise CommandError("Не найдено ни одного YAML-файла")
+
+        workers = max(1, min(options["workers"], len(files)))
+        started = time.perf_counter()
+        if workers == 1:
+            results = [import_file(path, options["full"]) for path in files]
+        else:
+            # соединения родителя не должны достаться дочерним процессам
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+                results = list(pool.map(import_file, files, [options["full"]] * len(files)))
+
+        self.report(results, time.perf_counter() - started)
+        failed = [result for result in results if "error" in result]
+        if failed:
+            raise CommandError(f"Не удалось импортировать файлов: {len(failed)}")
+
+    def report(self, results, elapsed):
+        row = "{:<30} {:<30} {:>9} {:>9} {:>9} {:>14}"
+        self.stdout.write(row.format("Файл", "Магазин", "Время, с", "Товаров", "Записано", "Характеристик"))
+        for result in results:
+            name = Path(result["file"]).name
+            if "error" in result:
+                self.stdout.write(self.style.ERROR(f"{name:<30} ошибка: {result['error']}"))
+                continue
+            self.stdout.write(row.format(
+                name, result["shop"], f"{result['seconds']:.2f}",
+                result["parsed"], result["goods"], result["parameters"],
+            ))
+        self.stdout.write(self.style.SUCCESS(f"Обработано файлов: {len(results)} за {elapsed:.2f} с"))
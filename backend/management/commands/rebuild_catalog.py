@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.cache import bump_catalog_version
+from backend.catalog import rebuild_catalog
+
+
+class Command(BaseCommand):
+    help = "Полностью пересобирает денормализованный каталог CatalogEntry"
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        count = rebuild_catalog()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f"Каталог пересобран: {count} записей"))
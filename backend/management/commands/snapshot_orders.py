@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.catalog import chunked
+from backend.checkout import snapshot_orders
+from backend.models import Order
+
+
+class Command(BaseCommand):
+    help = "Фиксирует цены и названия в заказах, подтверждённых до появления снимков"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        legacy = Order.objects.exclude(state=Order.States.CART).filter(total_amount__isnull=True)
+        ids = list(legacy.values_list("id", flat=True))
+        for chunk in chunked(ids, options["batch_size"]):
+            with transaction.atomic():
+                snapshot_orders(chunk)
+        self.stdout.write(self.style.SUCCESS(f"Зафиксировано заказов: {len(ids)}"))
@@ -0,0 +1,145 @@
+"""
+Метрики запросов к API: число SQL-запросов, время в базе, повторяющиеся
+запросы (признак N+1) и полное время ответа по каждому представлению.
+
+В режиме DEBUG цифры запроса отдаются в заголовках X-Query-*, а
+накопленные по представлениям - в текстовом формате Prometheus через
+metrics_view. Счётчики живут в памяти процесса: Prometheus опрашивает
+каждый процесс (воркер) отдельно.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограммы времени ответа, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class QueryStats:
+    """Обёртка connection.execute_wrapper: считает запросы одного HTTP-запроса"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duplicates(self):
+        """Сколько запросов повторили уже выполненный SQL (с другими параметрами)"""
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+
+class ViewMetrics:
+    """Накопленные метрики представлений процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def observe(self, view, stats, seconds):
+        with self.lock:
+            metrics = self.views.setdefault(view, {
+                "requests": 0, "queries": 0, "sql_seconds": 0.0, "duplicates": 0,
+                "seconds": 0.0, "buckets": [0] * len(DURATION_BUCKETS),
+            })
+            metrics["requests"] += 1
+            metrics["queries"] += stats.count
+            metrics["sql_seconds"] += stats.seconds
+            metrics["duplicates"] += stats.duplicates
+            metrics["seconds"] += seconds
+            for n, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    metrics["buckets"][n] += 1
+
+    def clear(self):
+        with self.lock:
+            self.views.clear()
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        with self.lock:
+            views = {view: dict(metrics, buckets=list(metrics["buckets"])) for view, metrics in self.views.items()}
+
+        lines = []
+        counters = (
+            ("api_requests_total", "requests", "Число запросов"),
+            ("api_db_queries_total", "queries", "Число SQL-запросов"),
+            ("api_db_query_seconds_total", "sql_seconds", "Время выполнения SQL, с"),
+            ("api_db_duplicate_queries_total", "duplicates", "Повторы одного SQL в запросе (N+1)"),
+        )
+        for name, key, help_text in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{view="{view}"}} {metrics[key]}' for view, metrics in sorted(views.items())]
+
+        name = "api_request_duration_seconds"
+        lines += [f"# HELP {name} Время ответа, с", f"# TYPE {name} histogram"]
+        for view, metrics in sorted(views.items()):
+            for bound, count in zip(DURATION_BUCKETS, metrics["buckets"]):
+                lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {metrics["requests"]}')
+            lines.append(f'{name}_sum{{view="{view}"}} {metrics["seconds"]}')
+            lines.append(f'{name}_count{{view="{view}"}} {metrics["requests"]}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = ViewMetrics()
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.view_name or match.route
+
+
+class QueryMetricsMiddleware:
+    """Считает SQL-запросы и время каждого HTTP-запроса (ставится первым в MIDDLEWARE)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        seconds = time.perf_counter() - started
+
+        view = view_label(request)
+        METRICS.observe(view, stats, seconds)
+        threshold = getattr(settings, "METRICS_DUPLICATE_WARNING", 10)
+        if stats.duplicates >= threshold:
+            logger.warning("%s: %s повторяющихся SQL-запросов из %s", view, stats.duplicates, stats.count)
+
+        if settings.DEBUG:
+            response["X-Query-Count"] = str(stats.count)
+            response["X-Query-Time-Ms"] = f"{stats.seconds * 1000:.1f}"
+            response["X-Query-Duplicates"] = str(stats.duplicates)
+            response["X-Response-Time-Ms"] = f"{seconds * 1000:.1f}"
+        return response
+
+
+def metrics_view(request):
+    """Метрики для Prometheus; доступны только адресам из METRICS_ALLOWED_IPS"""
+    if request.META.get("REMOTE_ADDR") not in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1"]):
+        return HttpResponseForbidden()
+    return HttpResponse(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
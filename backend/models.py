@@ -1,7 +1,12 @@
 from django.contrib.auth.base_user import BaseUserManager
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import AbstractUser
+from django.core.cache import cache
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 from django.core.mail import send_mail
@@ -21,6 +26,11 @@ class UserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    @classmethod
+    def normalize_email(cls, email):
+        """Email хранится в нижнем регистре: вход ищет его точным совпадением по уникальному индексу"""
+        return super().normalize_email((email or '').strip()).lower()
+
     def create_user(self, email, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', False)
         return self._create_user(email, password, **extra_fields)
@@ -54,6 +64,10 @@ class User(AbstractUser):
     def __str__(self):
         return f'{self.email} ({self.get_type_display()})'
 
+    def save(self, *args, **kwargs):
+        self.email = User.objects.normalize_email(self.email)
+        super().save(*args, **kwargs)
+
     @property
     def is_shop(self):
         return self.type == self.Types.SHOP
@@ -97,6 +111,11 @@ class Product(models.Model):
         on_delete=models.CASCADE, related_name='products'
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product_category'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -109,15 +128,31 @@ class ProductInfo(models.Model):
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(0)])
     price = models.DecimalField(max_digits=12, decimal_places=2)
     price_rrc = models.DecimalField(max_digits=12, decimal_places=2)
+    # Отпечаток строки прайса, из которой импортирована запись (см. data.import_data)
+    fingerprint = models.CharField(max_length=32, blank=True, editable=False)
 
     class Meta:
+        # Товар магазина определяется артикулом из прайса: у магазина может быть
+        # несколько товаров одного продукта (разные модели), а название продукта
+        # при повторном импорте может перейти к другому артикулу
         constraints = [
-            models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_shop'),
+            models.UniqueConstraint(fields=['shop', 'external_id'], name='unique_shop_external_id'),
+        ]
+        indexes = [
+            # id товаров магазина без чтения таблицы (панель заказов партнёра)
+            models.Index(fields=['shop', 'id'], name='product_info_shop_id_idx'),
         ]
 
     def __str__(self):
         return f"{self.product} @ {self.shop}"
 
+    def save(self, *args, **kwargs):
+        # Ручная правка расходится с прайсом: следующий импорт перезапишет запись
+        self.fingerprint = ''
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'fingerprint'}
+        return super().save(*args, **kwargs)
+
 class Parameter(models.Model):
     """Характеристика продукта"""
     name = models.CharField(max_length=100, unique=True)
@@ -136,9 +171,61 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'], name='uniq_param_per_product'),
         ]
+        indexes = [
+            # фасетный фильтр: товары с заданным значением характеристики без чтения таблицы
+            models.Index(fields=['parameter', 'value', 'product_info'], name='param_value_idx'),
+        ]
     def __str__(self):
         return f"{self.parameter.name} : {self.value}"
 
+class ParameterFacet(models.Model):
+    """Число товаров категории с данным значением характеристики (см. backend/facets.py)"""
+
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='facets')
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE, related_name='facets')
+    value = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'parameter', 'value'], name='uniq_facet_value'),
+        ]
+
+    def __str__(self):
+        return f"{self.parameter.name} = {self.value}: {self.count}"
+
+class CatalogEntry(models.Model):
+    """Денормализованная карточка товара для чтения каталога (см. backend/catalog.py)"""
+
+    product_info = models.OneToOneField(
+        ProductInfo, on_delete=models.CASCADE, primary_key=True, related_name='catalog_entry'
+    )
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='catalog_entries')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='catalog_entries')
+    name = models.CharField(max_length=100)
+    shop_name = models.CharField(max_length=100)
+    model = models.CharField(max_length=80, blank=True)
+    quantity = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=12, decimal_places=2)
+    parameters = models.JSONField(default=dict, blank=True)
+    # Значения характеристик одной строкой для полнотекстового поиска
+    parameters_text = models.TextField(blank=True)
+    # Заполняется только на PostgreSQL, GIN-индекс создаётся в backend/search.py
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    class Meta:
+        # Фильтры и сортировки списка товаров (filter_products + KeysetPagination)
+        indexes = [
+            models.Index(fields=["category", "price", "product_info"], name="catalog_category_price_idx"),
+            models.Index(fields=["shop", "price", "product_info"], name="catalog_shop_price_idx"),
+            models.Index(
+                fields=["price", "product_info"], condition=models.Q(quantity__gt=0), name="catalog_in_stock_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} @ {self.shop_name}"
+
 class Contact(models.Model):
     """Контактные данные покупателя"""
 
@@ -153,6 +240,30 @@ class Contact(models.Model):
         return f"{self.city}, {self.street}, {self.house}"
 
 
+# Сумма строки заказа в SQL: количество * цена товара
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def line_total(prefix=""):
+    # цена, зафиксированная при подтверждении, а для корзины - текущая цена товара
+    price = Coalesce(F(f"{prefix}price"), F(f"{prefix}product_info__price"), output_field=MONEY)
+    return ExpressionWrapper(F(f"{prefix}quantity") * price, output_field=MONEY)
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """Аннотирует заказы суммой total_sum, посчитанной в базе одним запросом"""
+        return self.annotate(total_sum=Coalesce(Sum(line_total("items__")), Value(0), output_field=MONEY))
+
+
+class OrderItemQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """Аннотирует строки суммой line_total = quantity * price"""
+        return self.annotate(line_total=line_total())
+
+
 class Order(models.Model):
     """Заказ"""
 
@@ -165,19 +276,74 @@ class Order(models.Model):
         DELIVERED = "delivered", _("Доставлен")
         CANCELED = "canceled", _("Отменен")
 
+    # Допустимые переходы; из корзины в новый заказ переводит только оформление (backend/checkout.py)
+    TRANSITIONS = {
+        States.CART: {States.NEW},
+        States.NEW: {States.CONFIRMED, States.CANCELED},
+        States.CONFIRMED: {States.ASSEMBLED, States.CANCELED},
+        States.ASSEMBLED: {States.SENT, States.CANCELED},
+        States.SENT: {States.DELIVERED},
+        States.DELIVERED: set(),
+        States.CANCELED: set(),
+    }
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders")
     created_at = models.DateTimeField(auto_now_add=True)
     state = models.CharField(max_length=15, choices=States.choices, default=States.CART)
     contact = models.ForeignKey(
         Contact, on_delete=models.SET_NULL, null=True, blank=True
     )
+    # Сумма заказа на момент подтверждения; у корзины не заполнена
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # не больше одной корзины у пользователя: поиск корзины - точечный запрос по индексу
+            models.UniqueConstraint(
+                fields=["user"], condition=models.Q(state="cart"), name="one_cart_per_user"
+            ),
+        ]
+        indexes = [
+            # keyset-пагинация заказов партнёра по (created_at, id)
+            models.Index(fields=["-created_at", "-id"], name="order_created_idx"),
+            models.Index(fields=["user", "state"], name="order_user_state_idx"),
+            # история покупателя без корзин, в порядке выдачи OrderListView
+            models.Index(
+                fields=["user", "-created_at", "-id"], condition=~models.Q(state="cart"), name="order_history_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"Order #{self.pk} ({self.get_state_display()})"
 
+    def can_transition(self, state):
+        return state in self.TRANSITIONS[self.state]
+
     @property
     def total(self):
-        return sum(item.total for item in self.items.all())
+        if hasattr(self, "total_sum"):
+            return self.total_sum
+        if self.total_amount is not None:
+            return self.total_amount
+        return self.items.aggregate(total=Coalesce(Sum(line_total()), Value(0), output_field=MONEY))["total"]
+
+
+class OrderStateChange(models.Model):
+    """История смены статусов заказа"""
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="state_changes")
+    from_state = models.CharField(max_length=15, choices=Order.States.choices)
+    to_state = models.CharField(max_length=15, choices=Order.States.choices)
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["created_at", "id"]
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.from_state} -> {self.to_state}"
 
 
 class OrderItem(models.Model):
@@ -188,6 +354,12 @@ class OrderItem(models.Model):
         ProductInfo, on_delete=models.CASCADE, related_name="order_items"
     )
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])
+    # Снимок товара на момент подтверждения заказа: история не меняется после импорта прайсов
+    price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    product_name = models.CharField(max_length=100, blank=True)
+    shop_name = models.CharField(max_length=100, blank=True)
+
+    objects = OrderItemQuerySet.as_manager()
 
     class Meta:
         constraints = [
@@ -195,9 +367,17 @@ class OrderItem(models.Model):
                 fields=["order", "product_info"], name="uniq_order_item"
             )
         ]
+        indexes = [
+            # обратный путь от товаров магазина к заказам (uniq_order_item начинается с order)
+            models.Index(fields=["product_info", "order"], name="order_item_info_order_idx"),
+        ]
 
     @property
     def total(self):
+        if hasattr(self, "line_total"):
+            return self.line_total
+        if self.price is not None:
+            return self.quantity * self.price
         return self.quantity * self.product_info.price
 
 
@@ -215,3 +395,65 @@ class ConfirmEmailToken(models.Model):
 
     def __str__(self):
         return f"Token for {self.user.email}"
+
+
+class ImportJob(models.Model):
+    """Фоновый импорт прайса поставщика"""
+
+    class States(models.TextChoices):
+        PENDING = "pending", _("В очереди")
+        RUNNING = "running", _("Выполняется")
+        DONE = "done", _("Завершён")
+        FAILED = "failed", _("Ошибка")
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="import_jobs")
+    url = models.URLField(verbose_name='Ссылка на прайс')
+    state = models.CharField(max_length=15, choices=States.choices, default=States.PENDING)
+    stats = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Import #{self.pk} ({self.get_state_display()})"
+
+    # Импорт идёт в одной транзакции, поэтому прогресс хранится в кэше, а не в строке задачи.
+    # Пишет его воркер Celery, а читает веб-процесс: кэш должен быть общим (см. backend/checks.py)
+    @property
+    def progress_key(self):
+        return f"import-job:{self.pk}:progress"
+
+    @property
+    def progress(self):
+        return cache.get(self.progress_key, {})
+
+    def set_progress(self, stats):
+        cache.set(self.progress_key, dict(stats), timeout=24 * 60 * 60)
+
+
+class OutgoingEmail(models.Model):
+    """Письмо в очереди на отправку (outbox)"""
+
+    class States(models.TextChoices):
+        PENDING = "pending", _("Ожидает отправки")
+        SENT = "sent", _("Отправлено")
+        FAILED = "failed", _("Не доставлено")
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+    state = models.CharField(max_length=15, choices=States.choices, default=States.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state", "next_attempt_at"], name="outbox_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.get_state_display()})"
@@ -0,0 +1,143 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError as FieldValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination:
+    """
+    Keyset-пагинация: следующая страница выбирается условием по ключу
+    сортировки последней строки (WHERE (price, id) > (...)), а не OFFSET,
+    поэтому глубокие страницы стоят столько же, сколько первая.
+    """
+
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering_query_param = 'ordering'
+    # Ключи сортировки; последним всегда идёт уникальное поле
+    orderings = {
+        'id': ('pk',),
+        'price': ('price', 'pk'),
+        '-price': ('-price', '-pk'),
+    }
+    default_ordering = 'id'
+
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        self.ordering_name = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        if self.ordering_name not in self.orderings:
+            raise ValidationError({self.ordering_query_param: f"Допустимые значения: {', '.join(self.orderings)}"})
+        self.ordering = self.orderings[self.ordering_name]
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def after(self, position):
+        """Условие «строго после position» в виде, пригодном для индекса по ключу"""
+        first = self.ordering[0]
+        condition = Q(**{self.lookup(first, 'gte'): position[0]})
+        tail = Q()
+        equal = {}
+        for field, value in zip(self.ordering, position):
+            tail |= Q(**equal, **{self.lookup(field, 'gt'): value})
+            equal[field.lstrip('-')] = value
+        return condition & tail
+
+    @staticmethod
+    def lookup(field, op):
+        if field.startswith('-'):
+            op = op.replace('gt', 'lt')
+        return f"{field.lstrip('-')}__{op}"
+
+    @staticmethod
+    def value(row, field):
+        name = field.lstrip('-')
+        return row[name] if isinstance(row, dict) else getattr(row, name)
+
+    def encode_cursor(self, row):
+        position = [str(self.value(row, field)) for field in self.ordering]
+        raw = json.dumps([self.ordering_name, position]).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    def decode_cursor(self, request, model):
+        """
+        Позиция из курсора со значениями, приведёнными к типам полей сортировки.
+        Курсор приходит от клиента, поэтому любая подделка - это 404, а не 500.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            ordering_name, position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        except (TypeError, ValueError):
+            raise NotFound("Неверный курсор")
+        if (
+            ordering_name != self.ordering_name
+            or not isinstance(position, list)
+            or len(position) != len(self.ordering)
+        ):
+            raise NotFound("Курсор не соответствует сортировке")
+        try:
+            return [self.parse(model, field, value) for field, value in zip(self.ordering, position)]
+        except (TypeError, ValueError, FieldValidationError):
+            raise NotFound("Неверный курсор")
+
+    @staticmethod
+    def parse(model, field, value):
+        if not isinstance(value, str):
+            raise TypeError(value)
+        name = field.lstrip('-')
+        model_field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+        parsed = model_field.to_python(value)
+        if parsed is None:
+            raise ValueError(value)
+        return parsed
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_first_link(self):
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "first": self.get_first_link(),
+            "results": data
+        })
+
+
+class OrderHistoryPagination(KeysetPagination):
+    """История заказов: новые сверху"""
+
+    page_size = 20
+    max_page_size = 100
+    orderings = {
+        '-created_at': ('-created_at', '-pk'),
+        'created_at': ('created_at', 'pk'),
+    }
+    default_ordering = '-created_at'
@@ -0,0 +1,157 @@
+"""
+Полнотекстовый поиск по каталогу.
+
+На PostgreSQL используется поле CatalogEntry.search_vector с GIN-индексом
+и триграммный индекс по названию (опечатки, порог задаёт
+pg_trgm.similarity_threshold). На других СУБД (SQLite в
+тестах) поиск идёт по инвертированному индексу в памяти процесса, который
+пересобирается при смене версии каталога.
+"""
+import re
+import threading
+from collections import defaultdict
+from difflib import get_close_matches
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+
+from .cache import CATALOG_VERSION_KEY, get_version
+from .models import CatalogEntry
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Веса совпадений в индексе для SQLite
+NAME_WEIGHT = 2.0
+FIELD_WEIGHT = 1.0
+PREFIX_FACTOR = 0.8
+FUZZY_FACTOR = 0.6
+
+
+def search_config():
+    return getattr(settings, "SEARCH_CONFIG", "russian")
+
+
+def is_postgresql():
+    return connection.vendor == "postgresql"
+
+
+def ensure_search_indexes(sender, using="default", **kwargs):
+    """Создаёт расширение pg_trgm и GIN-индексы каталога (post_migrate, только PostgreSQL)"""
+    from django.db import connections
+
+    db = connections[using]
+    if db.vendor != "postgresql":
+        return
+    table = db.ops.quote_name(CatalogEntry._meta.db_table)
+    with db.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS catalog_search_vector_idx ON {table} USING gin (search_vector)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS catalog_name_trgm_idx ON {table} USING gin (name gin_trgm_ops)")
+
+
+def update_search_vectors(product_info_ids):
+    """Пересчитывает search_vector для записей каталога (только PostgreSQL)"""
+    if not is_postgresql():
+        return
+    from django.contrib.postgres.search import SearchVector
+
+    config = search_config()
+    CatalogEntry.objects.filter(pk__in=product_info_ids).update(
+        search_vector=(
+            SearchVector("name", weight="A", config=config)
+            + SearchVector("model", weight="B", config=config)
+            + SearchVector("parameters_text", weight="C", config=config)
+        )
+    )
+
+
+def search_postgresql(queryset, query, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+
+    search_query = SearchQuery(query, config=search_config(), search_type="websearch")
+    return list(
+        queryset.annotate(
+            rank=SearchRank(F("search_vector"), search_query),
+            similarity=TrigramSimilarity("name", query),
+        ).filter(
+            Q(search_vector=search_query) | Q(name__trigram_similar=query)
+        ).order_by("-rank", "-similarity", "pk").values_list("pk", flat=True)[:limit]
+    )
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """Инвертированный индекс токен -> {id товара: вес} для СУБД без полнотекстового поиска"""
+
+    def __init__(self, rows):
+        self.postings = defaultdict(dict)
+        for pk, name, model, parameters_text in rows:
+            for weight, text in ((NAME_WEIGHT, name), (FIELD_WEIGHT, model), (FIELD_WEIGHT, parameters_text)):
+                for token in tokenize(text):
+                    postings = self.postings[token]
+                    postings[pk] = max(postings.get(pk, 0), weight)
+        self.vocabulary = sorted(self.postings)
+
+    def matches(self, token):
+        """Совпадения токена запроса: точное, по префиксу и с опечаткой"""
+        if token in self.postings:
+            yield token, 1.0
+        for candidate in self.vocabulary:
+            if candidate != token and candidate.startswith(token):
+                yield candidate, PREFIX_FACTOR
+        for candidate in get_close_matches(token, self.vocabulary, n=3, cutoff=0.75):
+            if candidate != token and not candidate.startswith(token):
+                yield candidate, FUZZY_FACTOR
+
+    def search(self, query):
+        """Ранжирует товары, в которых нашлись все слова запроса"""
+        scores = None
+        for token in tokenize(query):
+            token_scores = {}
+            for candidate, factor in self.matches(token):
+                for pk, weight in self.postings[candidate].items():
+                    token_scores[pk] = max(token_scores.get(pk, 0), weight * factor)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {pk: score + token_scores[pk] for pk, score in scores.items() if pk in token_scores}
+        return sorted(scores or {}, key=lambda pk: (-scores[pk], pk))
+
+
+_index_lock = threading.Lock()
+_index = (None, None)
+
+
+def get_inverted_index():
+    """Индекс по всему каталогу; пересобирается, когда меняется версия каталога"""
+    global _index
+    version = get_version(CATALOG_VERSION_KEY)
+    with _index_lock:
+        if _index[0] != version:
+            rows = CatalogEntry.objects.values_list("pk", "name", "model", "parameters_text")
+            _index = (version, InvertedIndex(rows.iterator()))
+        return _index[1]
+
+
+def search_catalog(queryset, query, limit=50):
+    """Возвращает id товаров из queryset, подходящих под запрос, по убыванию релевантности"""
+    if is_postgresql():
+        return search_postgresql(queryset, query, limit)
+
+    ranked = get_inverted_index().search(query)
+    if not queryset.query.where:
+        return ranked[:limit]
+
+    # Фильтры каталога применяются к кандидатам по порядку релевантности
+    found = []
+    for start in range(0, len(ranked), 500):
+        chunk = ranked[start:start + 500]
+        allowed = set(queryset.filter(pk__in=chunk).values_list("pk", flat=True))
+        found.extend(pk for pk in chunk if pk in allowed)
+        if len(found) >= limit:
+            break
+    return found[:limit]
@@ -0,0 +1,105 @@
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import forget_tokens
+from .cache import bump_catalog_version
+from .catalog import refresh_catalog_entries
+from .facets import refresh_facets
+from .throttling import forget_unknown_email
+from .models import User, Shop, Product, ProductInfo, ProductParameter, CatalogEntry
+
+
+def deleted_directly(instance, origin):
+    """Удаление начато с самого объекта, а не каскадом от родителя"""
+    if isinstance(origin, QuerySet):
+        return origin.model is type(instance)
+    return origin is None or origin is instance
+
+
+def product_category(product_id):
+    return Product.objects.filter(id=product_id).values_list("category_id", flat=True)
+
+
+def stored_value(instance, field, update_fields):
+    """
+    Значение поля в базе перед сохранением, если оно сохраняется и меняется;
+    иначе None. Нужно, чтобы не пересчитывать фасеты при смене цены или названия.
+    """
+    attname = type(instance)._meta.get_field(field).attname
+    if instance.pk is None or (update_fields is not None and not {field, attname} & set(update_fields)):
+        return None
+    old = type(instance).objects.filter(pk=instance.pk).values_list(attname, flat=True).first()
+    return old if old != getattr(instance, attname) else None
+
+
+@receiver(pre_save, sender=ProductInfo)
+def product_info_saving(sender, instance, update_fields=None, **kwargs):
+    instance._moved_from_product = stored_value(instance, "product", update_fields)
+
+
+@receiver(post_save, sender=ProductInfo)
+def product_info_saved(sender, instance, **kwargs):
+    refresh_catalog_entries([instance.id])
+    # у нового товара ещё нет характеристик; счётчики меняет только переход в другой продукт
+    moved_from = getattr(instance, "_moved_from_product", None)
+    if moved_from is not None:
+        refresh_facets([*product_category(moved_from), *product_category(instance.product_id)])
+    bump_catalog_version([instance.shop_id])
+
+
+@receiver(post_delete, sender=ProductInfo)
+def product_info_deleted(sender, instance, **kwargs):
+    # запись каталога удаляется каскадом
+    refresh_facets(product_category(instance.product_id))
+    bump_catalog_version([instance.shop_id])
+
+
+@receiver([post_save, post_delete], sender=ProductParameter)
+def product_parameter_changed(sender, instance, origin=None, **kwargs):
+    if kwargs.get("signal") is post_delete and not deleted_directly(instance, origin):
+        return
+    rows = ProductInfo.objects.filter(id=instance.product_info_id).values_list("shop_id", "product__category_id")
+    refresh_catalog_entries([instance.product_info_id])
+    refresh_facets([category_id for _, category_id in rows])
+    bump_catalog_version([shop_id for shop_id, _ in rows])
+
+
+@receiver(pre_save, sender=Product)
+def product_saving(sender, instance, update_fields=None, **kwargs):
+    instance._moved_from_category = stored_value(instance, "category", update_fields)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    # название продукта показывается во всех магазинах, где он продаётся
+    rows = list(ProductInfo.objects.filter(product_id=instance.id).values_list("id", "shop_id"))
+    refresh_catalog_entries([info_id for info_id, _ in rows])
+    moved_from = getattr(instance, "_moved_from_category", None)
+    if rows and moved_from is not None:
+        refresh_facets([moved_from, instance.category_id])
+    bump_catalog_version([shop_id for _, shop_id in rows])
+
+
+@receiver(post_save, sender=Shop)
+def shop_saved(sender, instance, **kwargs):
+    CatalogEntry.objects.filter(shop_id=instance.id).update(shop_name=instance.name)
+    bump_catalog_version([instance.id])
+
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if created:
+        # email мог попасть в кэш неизвестных до регистрации
+        forget_unknown_email(instance.email)
+    # деактивация, смена пароля или прав должны сразу отражаться на запросах с токеном;
+    # отметка о входе (update_last_login) кэш не сбрасывает
+    if not created and set(update_fields or ()) != {"last_login"}:
+        forget_tokens(Token.objects.filter(user=instance).values_list("key", flat=True))
@@ -0,0 +1,42 @@
+import requests
+from celery import shared_task
+from django.utils import timezone
+
+from backend.mail import deliver_outbox
+from backend.models import ImportJob
+from data.import_data import import_shop_from_stream
+
+# Таймаут (соединение, чтение) при скачивании прайса поставщика
+DOWNLOAD_TIMEOUT = (10, 60)
+
+
+@shared_task
+def do_import(job_id):
+    """Скачивает прайс по ссылке из задачи и импортирует его потоком"""
+    job = ImportJob.objects.select_related("user").get(id=job_id)
+    job.state = ImportJob.States.RUNNING
+    job.save(update_fields=["state"])
+
+    try:
+        with requests.get(job.url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            stats = import_shop_from_stream(response.raw, user=job.user, progress=job.set_progress)
+    except Exception as error:
+        job.state = ImportJob.States.FAILED
+        job.error = str(error)
+    else:
+        job.state = ImportJob.States.DONE
+        job.stats = stats
+        job.set_progress(stats)
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=["state", "stats", "error", "finished_at"])
+    return job.state
+
+
+@shared_task
+def send_outbox():
+    """Отправляет накопившиеся письма из очереди OutgoingEmail"""
+    sent, failed = deliver_outbox()
+    return {"sent": sent, "failed": failed}
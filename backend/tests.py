@@ -1,3 +1,1575 @@
-from django.test import TestCase
+import base64
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+import yaml
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from backend.authentication import get_auth_cache
+from backend.cache import bump_catalog_version, get_catalog_cache
+from backend.checks import check_shared_caches
+from backend.mail import deliver_outbox, queue_email
+from backend.middleware import METRICS, QueryStats
+from backend.pagination import KeysetPagination
+from backend.throttling import get_login_cache, is_unknown_email
+from backend.catalog import check_catalog, refresh_catalog_entries
+from backend.basket import add_to_basket, find_cart_id, get_or_create_cart_id
+from backend.checkout import confirm_order
+from backend.facets import refresh_facets, stored_facets
+from backend.inventory import OutOfStock
+from backend.models import (
+    User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, ParameterFacet, ImportJob, CatalogEntry,
+    Order, OrderItem, Contact, OutgoingEmail, ConfirmEmailToken, OrderStateChange,
+)
+from data.feed import iter_feed
+from data.import_data import import_shop_from_stream, import_shop_from_yaml
+
+SHOP1_YAML = Path(__file__).resolve().parent.parent / "data" / "shop1.yaml"
+
+
+def make_feed(goods_count, shop="Тестовый магазин", price=100):
+    """Прайс в формате shop1.yaml с заданным числом товаров"""
+    return {
+        "shop": shop,
+        "categories": [{"id": 1, "name": "Смартфоны"}],
+        "goods": [
+            {
+                "id": 1000 + n,
+                "category": 1,
+                "model": f"model/{n}",
+                "name": f"Товар {n}",
+                "price": price,
+                "price_rrc": price + 10,
+                "quantity": n,
+                "parameters": {"Цвет": "черный", "Память (Гб)": n % 4 * 64},
+            }
+            for n in range(goods_count)
+        ],
+    }
+
+
+def write_feed(directory, data, name="shop.yaml"):
+    path = Path(directory) / name
+    path.write_text(yaml.safe_dump(data, allow_unicode=True, sort_keys=False), encoding="utf-8")
+    return path
+
+
+class ImportShopTests(TestCase):
+
+    def test_import_shop1(self):
+        import_shop_from_yaml(SHOP1_YAML)
+
+        data = yaml.safe_load(SHOP1_YAML.read_text(encoding="utf-8"))
+        self.assertEqual(Shop.objects.get().name, data["shop"])
+        self.assertEqual(Category.objects.count(), len(data["categories"]))
+        self.assertEqual(ProductInfo.objects.count(), len(data["goods"]))
+        self.assertEqual(
+            ProductParameter.objects.count(),
+            sum(len(item.get("parameters", {})) for item in data["goods"]),
+        )
+
+    def test_reimport_updates_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(5)))
+            info_ids = set(ProductInfo.objects.values_list("id", flat=True))
+
+            import_shop_from_yaml(write_feed(tmp, make_feed(5, price=200)))
+
+        self.assertEqual(set(ProductInfo.objects.values_list("id", flat=True)), info_ids)
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertFalse(ProductInfo.objects.exclude(price=200).exists())
+
+    def test_query_count_does_not_grow_with_goods(self):
+        counts = []
+        with tempfile.TemporaryDirectory() as tmp:
+            # прогрев: категории и характеристики уже есть в базе
+            import_shop_from_yaml(write_feed(tmp, make_feed(1, shop="Прогрев")))
+            for goods_count in (3, 60):
+                path = write_feed(tmp, make_feed(goods_count, shop=f"Магазин {goods_count}"))
+                with CaptureQueriesContext(connection) as ctx:
+                    import_shop_from_yaml(path)
+                counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_unknown_category(self):
+        feed = make_feed(1)
+        feed["goods"][0]["category"] = 999
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(Category.DoesNotExist):
+                import_shop_from_yaml(write_feed(tmp, feed))
+
+    def test_import_from_unseekable_stream(self):
+        class Response(BytesIO):
+            def seekable(self):
+                return False
+
+        stream = Response(yaml.safe_dump(make_feed(3), allow_unicode=True).encode("utf-8"))
+        stats = import_shop_from_stream(stream)
+
+        self.assertEqual(stats["goods"], 3)
+        self.assertEqual(ProductInfo.objects.count(), 3)
+
+    def test_shared_rows_survive_failed_shop_import(self):
+        owner = User.objects.create_user(email="owner@example.com", password="x", type=User.Types.SHOP)
+        Shop.objects.create(name="Тестовый магазин", user=owner)
+        partner = User.objects.create_user(email="partner@example.com", password="x", type=User.Types.SHOP)
+
+        stream = BytesIO(yaml.safe_dump(make_feed(2), allow_unicode=True).encode("utf-8"))
+        with self.assertRaises(ValueError):
+            import_shop_from_stream(stream, user=partner)
+
+        # общие строки создаются своими транзакциями до импорта магазина
+        self.assertEqual(Category.objects.count(), 1)
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertFalse(ProductInfo.objects.exists())
+
+
+class FeedReaderTests(TestCase):
+
+    def test_stream_matches_full_document(self):
+        with open(SHOP1_YAML, "rb") as f:
+            events = list(iter_feed(f))
+
+        data = yaml.safe_load(SHOP1_YAML.read_text(encoding="utf-8"))
+        self.assertEqual(events[0], ("shop", data["shop"]))
+        self.assertEqual(events[1], ("categories", data["categories"]))
+        self.assertEqual([value for key, value in events[2:]], data["goods"])
+        self.assertTrue(all(key == "goods" for key, _ in events[2:]))
+
+    def test_sections_in_any_order(self):
+        feed = make_feed(3)
+        for item in feed["goods"]:
+            item["category"] = 7
+        feed["categories"] = [{"id": 7, "name": "Планшеты"}]
+        orders = [("goods", "categories", "shop"), ("shop", "goods", "categories"), ("categories", "goods", "shop")]
+        with tempfile.TemporaryDirectory() as tmp:
+            for order in orders:
+                stats = import_shop_from_yaml(write_feed(tmp, {key: feed[key] for key in order}), full=True)
+                self.assertEqual((stats["parsed"], stats["goods"], stats["categories"]), (3, 3, 1), order)
+
+        self.assertEqual(Shop.objects.get().name, feed["shop"])
+        self.assertEqual(set(ProductInfo.objects.values_list("product__category_id", flat=True)), {7})
+
+    def test_feed_without_shop(self):
+        feed = make_feed(1)
+        del feed["shop"]
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaisesMessage(ValueError, "не указан магазин"):
+                import_shop_from_yaml(write_feed(tmp, feed))
+
+
+class DeltaImportTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def import_feed(self, feed, **kwargs):
+        return import_shop_from_yaml(write_feed(self.tmp.name, feed), **kwargs)
+
+    def test_unchanged_feed_writes_nothing(self):
+        self.import_feed(make_feed(10))
+
+        with CaptureQueriesContext(connection) as ctx:
+            stats = self.import_feed(make_feed(10))
+
+        writes = [
+            q["sql"] for q in ctx.captured_queries
+            if q["sql"].lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+        self.assertEqual(writes, [])
+        self.assertEqual(stats["goods"], 0)
+        self.assertEqual(stats["unchanged"], 10)
+
+    def test_only_changed_goods_are_written(self):
+        self.import_feed(make_feed(10))
+        feed = make_feed(10)
+        feed["goods"][3]["price"] = 555
+        feed["goods"][3]["parameters"] = {"Цвет": "белый"}
+
+        stats = self.import_feed(feed)
+
+        self.assertEqual((stats["goods"], stats["unchanged"]), (1, 9))
+        self.assertEqual((stats["parameters"], stats["removed"]), (1, 1))
+        info = ProductInfo.objects.get(external_id=1003)
+        self.assertEqual(info.price, 555)
+        self.assertEqual({p.parameter.name: p.value for p in info.parameters.all()}, {"Цвет": "белый"})
+
+    def test_manual_edit_is_overwritten_by_next_import(self):
+        self.import_feed(make_feed(2))
+        info = ProductInfo.objects.get(external_id=1000)
+        info.price = 1
+        info.save(update_fields=["price"])
+
+        self.import_feed(make_feed(2))
+
+        info.refresh_from_db()
+        self.assertEqual(info.price, 100)
+
+    def test_removed_parameters_cost_fixed_queries(self):
+        counts = []
+        for goods_count in (5, 50):
+            ProductInfo.objects.all().delete()
+            self.import_feed(make_feed(goods_count))
+            feed = make_feed(goods_count)
+            for item in feed["goods"]:
+                del item["parameters"]["Цвет"]
+            with CaptureQueriesContext(connection) as ctx:
+                stats = self.import_feed(feed)
+            self.assertEqual(stats["removed"], goods_count)
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertNotIn("Цвет", stored_facets(1))
+        self.assertEqual(check_catalog(), {'missing': [], 'extra': [], 'stale': []})
+
+    def test_skus_of_one_product(self):
+        feed = make_feed(3)
+        feed["goods"][1]["name"] = feed["goods"][0]["name"]
+
+        self.assertEqual(self.import_feed(feed)["goods"], 3)
+        stats = self.import_feed(feed)
+
+        self.assertEqual((stats["goods"], stats["unchanged"]), (0, 3))
+        self.assertEqual(ProductInfo.objects.count(), 3)
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_names_swapped_between_skus(self):
+        feed = make_feed(2)
+        self.import_feed(feed)
+        first, second = feed["goods"]
+        first["name"], second["name"] = second["name"], first["name"]
+
+        self.assertEqual(self.import_feed(feed)["goods"], 2)
+        names = dict(ProductInfo.objects.values_list("external_id", "product__name"))
+        self.assertEqual(names, {1000: "Товар 1", 1001: "Товар 0"})
+        self.assertEqual(check_catalog(), {'missing': [], 'extra': [], 'stale': []})
+
+    def test_full_mode_rewrites_everything(self):
+        self.import_feed(make_feed(4))
+        stats = self.import_feed(make_feed(4), full=True)
+        self.assertEqual((stats["goods"], stats["unchanged"]), (4, 0))
+
+
+class PartnerUpdateTests(TestCase):
+
+    def setUp(self):
+        from orders.celery import app
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", eager)
+
+        self.user = User.objects.create_user(email="shop@example.com", password="pass", type=User.Types.SHOP)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fake_download(self, path):
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.raw = open(path, "rb")
+        self.addCleanup(response.raw.close)
+        return mock.patch("backend.tasks.requests.get", return_value=response)
+
+    def test_import_runs_in_background_job(self):
+        with self.fake_download(SHOP1_YAML), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/partner/update/", {"url": "https://example.com/shop1.yaml"})
+
+        self.assertEqual(response.status_code, 202)
+        job = ImportJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.state, ImportJob.States.DONE)
+        self.assertEqual(Shop.objects.get().user, self.user)
+
+        status = self.client.get(f"/partner/update/{job.id}/").data
+        self.assertEqual(status["state"], ImportJob.States.DONE)
+        self.assertEqual(status["stats"]["goods"], ProductInfo.objects.count())
+        self.assertEqual(status["progress"]["parsed"], ProductInfo.objects.count())
+
+    def test_failed_import_is_reported(self):
+        Shop.objects.create(name="Связной", user=User.objects.create_user(email="other@example.com"))
+
+        with self.fake_download(SHOP1_YAML), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/partner/update/", {"url": "https://example.com/shop1.yaml"})
+
+        job = ImportJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.state, ImportJob.States.FAILED)
+        self.assertIn("другому пользователю", job.error)
+        self.assertFalse(ProductInfo.objects.exists())
+
+    def test_buyer_cannot_import(self):
+        self.user.type = User.Types.BUYER
+        self.user.save()
+        response = self.client.post("/partner/update/", {"url": "https://example.com/shop1.yaml"})
+        self.assertEqual(response.status_code, 403)
+
+
+class SharedCacheCheckTests(TestCase):
+
+    def test_local_cache_fails_deploy_check(self):
+        self.assertEqual([error.id for error in check_shared_caches(None)], ["backend.E001", "backend.E001"])
+
+        redis = {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://localhost:6379"}
+        with override_settings(CACHES={"default": redis}):
+            self.assertEqual(check_shared_caches(None), [])
+
+        local = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        with override_settings(CACHES={"default": redis, "catalog": local}, CATALOG_CACHE="catalog"):
+            errors = check_shared_caches(None)
+        self.assertEqual(len(errors), 1)
+        self.assertIn("версии каталога", errors[0].msg)
+
+
+class ImportShopsCommandTests(TestCase):
+
+    def test_imports_directory_and_reports(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            write_feed(tmp, make_feed(3, shop="Магазин А"), name="a.yaml")
+            write_feed(tmp, make_feed(5, shop="Магазин Б"), name="b.yml")
+            call_command("import_shops", tmp, workers=1, stdout=out)
+
+        report = out.getvalue()
+        self.assertIn("Магазин А", report)
+        self.assertIn("Магазин Б", report)
+        # категории и характеристики общие для обоих магазинов
+        self.assertEqual(Category.objects.count(), 1)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertEqual(ProductInfo.objects.count(), 8)
+
+    def test_failed_file_is_reported(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            write_feed(tmp, {"categories": []}, name="broken.yaml")
+            with self.assertRaises(CommandError):
+                call_command("import_shops", str(Path(tmp) / "*.yaml"), workers=1, stdout=out)
+
+        self.assertIn("broken.yaml", out.getvalue())
+
+
+class ParallelImportShopsTests(TransactionTestCase):
+    """Параллельные импорты создают общие категории, продукты и характеристики по одному разу"""
+
+    # процессы не видят тестовую базу в памяти, поэтому воркеры - потоки;
+    # SQLite пишет по одному, и занятая база лечится повтором импорта
+    @mock.patch("backend.management.commands.import_shops.ProcessPoolExecutor", ThreadPoolExecutor)
+    @mock.patch("backend.management.commands.import_shops.IMPORT_ATTEMPTS", 100)
+    @mock.patch("backend.management.commands.import_shops.RETRY_DELAY", 0.01)
+    def test_workers_share_catalog_rows(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            for n in range(3):
+                write_feed(tmp, make_feed(20, shop=f"Магазин {n}", price=100 + n), name=f"shop{n}.yaml")
+            call_command("import_shops", tmp, workers=3, stdout=out)
+
+        self.assertIn("Обработано файлов: 3", out.getvalue())
+        self.assertEqual(Category.objects.count(), 1)
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertEqual(ProductInfo.objects.count(), 60)
+        self.assertEqual(stored_facets(1)["Цвет"], {"черный": 60})
+        self.assertEqual(check_catalog(), {'missing': [], 'extra': [], 'stale': []})
+
+
+class ProductListTests(TestCase):
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.client = APIClient()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_parameters_are_listed(self):
+        import_shop_from_yaml(SHOP1_YAML)
+        response = self.client.get("/products/")
+
+        self.assertEqual(response.status_code, 200)
+        first = response.data["results"][0]
+        info = ProductInfo.objects.order_by("id").first()
+        self.assertEqual(first["name"], info.product.name)
+        self.assertEqual(first["parameters"], {p.parameter.name: p.value for p in info.parameters.all()})
+
+    def test_query_count_is_constant(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(2, shop="Маленький")))
+        with CaptureQueriesContext(connection) as small:
+            self.client.get("/products/")
+
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(40, shop="Большой")))
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get("/products/")
+
+        self.assertEqual(len(response.data["results"]), 42)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertEqual(len(large.captured_queries), 1)
+
+    def collect_pages(self, url):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(row["id"] for row in response.data["results"])
+            url = response.data["next"]
+            pages += 1
+        return ids, pages
+
+    def test_keyset_pages_cover_catalog(self):
+        feed = make_feed(25)
+        for n, item in enumerate(feed["goods"]):
+            item["price"] = 100 + n % 3 * 10
+        import_shop_from_yaml(write_feed(self.tmp.name, feed))
+
+        ids, pages = self.collect_pages("/products/?page_size=4&ordering=price")
+        expected = list(ProductInfo.objects.order_by("price", "id").values_list("id", flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 7)
+
+        ids, _ = self.collect_pages("/products/?page_size=4&ordering=-price")
+        self.assertEqual(ids, expected[::-1])
+
+    def test_deep_page_query_has_no_offset(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(10)))
+        next_url = self.client.get("/products/?page_size=3").data["next"]
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(next_url)
+        self.assertNotIn("OFFSET", ctx.captured_queries[0]["sql"].upper())
+
+    def test_forged_cursor_is_not_found(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(3)))
+
+        def cursor(payload):
+            return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+        forged = [
+            ("id", "not-base64!"),
+            ("id", cursor({"id": 1})),
+            ("id", cursor(["id", "1"])),
+            ("id", cursor(["id", ["1", "2"]])),
+            ("id", cursor(["id", [1]])),
+            ("id", cursor(["id", ["abc"]])),
+            ("price", cursor(["price", ["Infinity", "1"]])),
+            ("price", cursor(["price", [["100"], "1"]])),
+        ]
+        for ordering, value in forged:
+            response = self.client.get("/products/", {"cursor": value, "ordering": ordering})
+            self.assertEqual(response.status_code, 404, value)
+
+        response = self.client.get("/products/", {"cursor": cursor(["price", ["100.00", "1"]]), "ordering": "price"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_filters(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(10)))
+        shop = Shop.objects.get()
+
+        response = self.client.get(f"/products/?shop={shop.id}&category=1&price_min=100&price_max=100&in_stock=1")
+        self.assertEqual(len(response.data["results"]), 9)
+
+        response = self.client.get("/products/?in_stock=0")
+        self.assertEqual(len(response.data["results"]), 1)
+
+        response = self.client.get("/products/?price_min=abc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_finite_prices_are_rejected(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(2)))
+        for url in ("/products/", "/products/facets/", "/products/search/"):
+            for value in ("Infinity", "-inf", "NaN", "sNaN"):
+                for param in ("price_min", "price_max"):
+                    response = self.client.get(url, {"q": "Товар", param: value})
+                    self.assertEqual(response.status_code, 400, (url, param, value))
+                    self.assertEqual(response.data["error"], "Неверные параметры фильтра")
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.client = APIClient()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(3)))
+
+    def prices(self, url="/products/"):
+        return [row["price"] for row in self.client.get(url).data["results"]]
+
+    def test_hot_read_does_not_touch_database(self):
+        self.prices()
+        with self.assertNumQueries(0):
+            self.prices()
+
+    def test_import_invalidates_cache(self):
+        shop = Shop.objects.get()
+        self.prices()
+        self.prices(f"/products/?shop={shop.id}")
+
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(3, price=300)))
+
+        self.assertEqual(set(self.prices()), {300})
+        self.assertEqual(set(self.prices(f"/products/?shop={shop.id}")), {300})
+
+    def test_admin_edit_invalidates_cache(self):
+        self.prices()
+        info = ProductInfo.objects.order_by("id").first()
+        info.price = 1
+        info.save()
+
+        self.assertEqual(self.prices()[0], 1)
+
+    def test_other_shop_keeps_its_cache(self):
+        shop = Shop.objects.get()
+        self.prices(f"/products/?shop={shop.id}")
+
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(2, shop="Другой")))
+
+        with self.assertNumQueries(0):
+            self.prices(f"/products/?shop={shop.id}")
+
+    def test_page_read_during_import_is_not_cached_under_new_version(self):
+        read = KeysetPagination.paginate_queryset
+
+        def read_then_import(paginator, queryset, request):
+            rows = read(paginator, queryset, request)
+            # импорт сменил версию после того, как запрос прочитал старые цены
+            bump_catalog_version()
+            return rows
+
+        with mock.patch.object(KeysetPagination, "paginate_queryset", read_then_import):
+            self.prices()
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.prices()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+
+class CatalogEntryTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def assertConsistent(self):
+        self.assertEqual(check_catalog(), {"missing": [], "extra": [], "stale": []})
+
+    def test_import_maintains_catalog(self):
+        import_shop_from_yaml(SHOP1_YAML)
+        self.assertEqual(CatalogEntry.objects.count(), ProductInfo.objects.count())
+        self.assertConsistent()
+
+        feed = make_feed(4)
+        import_shop_from_yaml(write_feed(self.tmp.name, feed))
+        feed["goods"][0]["parameters"] = {"Цвет": "белый"}
+        import_shop_from_yaml(write_feed(self.tmp.name, feed))
+
+        entry = CatalogEntry.objects.get(product_info__external_id=1000)
+        self.assertEqual(entry.parameters, {"Цвет": "белый"})
+        self.assertConsistent()
+
+    def test_signals_maintain_catalog(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(3)))
+        info = ProductInfo.objects.order_by("id").first()
+
+        info.product.name = "Новое имя"
+        info.product.save()
+        info.shop.name = "Новый магазин"
+        info.shop.save()
+        info.parameters.first().delete()
+        self.assertConsistent()
+
+        info.delete()
+        self.assertEqual(CatalogEntry.objects.count(), 2)
+        self.assertConsistent()
+
+    def test_parameters_are_ordered_by_name(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(1)))
+
+        entry = CatalogEntry.objects.get()
+        self.assertEqual(list(entry.parameters), ["Память (Гб)", "Цвет"])
+        self.assertEqual(entry.parameters_text, "0 черный")
+
+    def test_check_and_rebuild_commands(self):
+        import_shop_from_yaml(write_feed(self.tmp.name, make_feed(3)))
+        ProductInfo.objects.update(price=1)  # обходит сигналы
+
+        with self.assertRaises(CommandError):
+            call_command("check_catalog", stdout=StringIO())
+        call_command("check_catalog", fix=True, stdout=StringIO())
+        self.assertConsistent()
+
+        CatalogEntry.objects.all().delete()
+        call_command("rebuild_catalog", stdout=StringIO())
+        self.assertEqual(CatalogEntry.objects.count(), 3)
+        self.assertConsistent()
+
+
+class ProductFacetTests(TestCase):
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.client = APIClient()
+        feed = make_feed(6)
+        for n, item in enumerate(feed["goods"]):
+            item["parameters"] = {"Цвет": ["черный", "белый"][n % 2], "Память (Гб)": [128, 256, 512][n % 3]}
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, feed))
+
+    def test_stored_facets_without_filters(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/products/facets/?category=1")
+
+        self.assertEqual(response.data["facets"]["Цвет"], {"черный": 3, "белый": 3})
+        self.assertEqual(len(response.data["results"]), 6)
+        self.assertFalse(any("productparameter" in q["sql"] for q in ctx.captured_queries))
+
+    def test_param_filters_and_live_counts(self):
+        url = "/products/facets/?" + urlencode(
+            [("param[Цвет]", "черный"), ("param[Память (Гб)]", "128"), ("param[Память (Гб)]", "256")]
+        )
+        response = self.client.get(url)
+
+        results = response.data["results"]
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(row["parameters"]["Цвет"] == "черный" for row in results))
+        # по выбранной характеристике видны и остальные значения
+        self.assertEqual(response.data["facets"]["Цвет"], {"черный": 2, "белый": 2})
+        self.assertEqual(response.data["facets"]["Память (Гб)"], {"128": 1, "256": 1, "512": 1})
+
+    def test_facets_follow_parameter_changes(self):
+        value = ProductParameter.objects.filter(parameter__name="Цвет", value="белый").first()
+        value.value = "красный"
+        value.save()
+
+        response = self.client.get("/products/facets/?category=1")
+        self.assertEqual(response.data["facets"]["Цвет"], {"черный": 3, "белый": 2, "красный": 1})
+
+    def test_price_change_does_not_recount(self):
+        facet_ids = set(ParameterFacet.objects.values_list("id", flat=True))
+        info = ProductInfo.objects.first()
+        info.price = 1
+        with CaptureQueriesContext(connection) as ctx:
+            info.save()
+
+        self.assertFalse(any("parameterfacet" in q["sql"] for q in ctx.captured_queries))
+        self.assertEqual(set(ParameterFacet.objects.values_list("id", flat=True)), facet_ids)
+
+    def test_category_move_recounts_both_categories(self):
+        other = Category.objects.create(name="Планшеты")
+        product = Product.objects.get(items__external_id=1001)  # белый
+        product.category = other
+        product.save()
+
+        self.assertEqual(stored_facets(1)["Цвет"], {"черный": 3, "белый": 2})
+        self.assertEqual(stored_facets(other.id)["Цвет"], {"белый": 1})
+
+    def test_refresh_updates_counts_in_place(self):
+        facet = ParameterFacet.objects.get(category_id=1, value="черный")
+        ProductParameter.objects.filter(value="белый").update(value="черный")
+
+        refresh_facets([1])
+
+        self.assertEqual(ParameterFacet.objects.get(category_id=1, value="черный").pk, facet.pk)
+        self.assertEqual(stored_facets(1)["Цвет"], {"черный": 6})
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.client = APIClient()
+        import_shop_from_yaml(SHOP1_YAML)
+
+    def search(self, query, **params):
+        response = self.client.get("/products/search/", {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [row["name"] for row in response.data["results"]]
+
+    def test_all_words_must_match(self):
+        names = self.search("iPhone XR 256")
+        self.assertTrue(names)
+        self.assertTrue(all("XR" in name for name in names))
+        self.assertTrue(all("256" in name or "128" in name for name in names))
+        self.assertIn("256GB", names[0])
+
+    def test_typo_and_parameter_value(self):
+        self.assertTrue(all("iPhone" in name for name in self.search("iphon")))
+        self.assertTrue(all("(черный)" in name for name in self.search("iphone черный")))
+        self.assertTrue(self.search("iphnoe"))
+
+    def test_filters_and_reindex_after_import(self):
+        category = Category.objects.get(name="Смартфоны")
+        self.assertEqual(self.search("iphone", category=category.id + 1000), [])
+
+        info = ProductInfo.objects.filter(product__name__contains="XR").first()
+        info.product.name = "Смартфон Pixel"
+        info.product.save()
+        self.assertEqual(self.search("pixel"), ["Смартфон Pixel"])
+
+    def test_query_required(self):
+        self.assertEqual(self.client.get("/products/search/").status_code, 400)
+
+
+class BasketBatchTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(40)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        self.user = User.objects.create_user(email="buyer@example.com", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post_items(self, items):
+        return self.client.post("/basket/batch/", {"items": items}, format="json")
+
+    def basket(self):
+        return dict(OrderItem.objects.filter(order__user=self.user).values_list("product_info_id", "quantity"))
+
+    def test_batch_adds_and_increments(self):
+        self.client.post("/basket/add/", {"product_info": self.ids[0], "quantity": 2})
+
+        response = self.post_items([
+            {"product_info": self.ids[0], "quantity": 3},
+            {"product_info": self.ids[1], "quantity": 1},
+            {"product_info": self.ids[1], "quantity": 4},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["created"], response.data["updated"]), (1, 1))
+        self.assertEqual(self.basket(), {self.ids[0]: 5, self.ids[1]: 5})
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+
+    def test_unknown_product_changes_nothing(self):
+        response = self.post_items([{"product_info": self.ids[0]}, {"product_info": 999999}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.basket(), {})
+
+    def test_invalid_items(self):
+        self.assertEqual(self.post_items([{"product_info": self.ids[0], "quantity": 0}]).status_code, 400)
+        self.assertEqual(self.post_items("abc").status_code, 400)
+        response = self.client.post("/basket/add/", {"product_info": self.ids[0], "quantity": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        counts = []
+        for ids in (self.ids[:3], self.ids[3:33]):
+            # половина позиций уже в корзине, половина новые
+            self.post_items([{"product_info": pk} for pk in ids[::2]])
+            with CaptureQueriesContext(connection) as ctx:
+                self.post_items([{"product_info": pk, "quantity": 2} for pk in ids])
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+
+
+def make_buyer(email):
+    user = User.objects.create_user(email=email, password="pass", is_active=True)
+    contact = Contact.objects.create(user=user, city="Москва", street="Ленина", house="1", phone="+70000000000")
+    return user, contact
+
+
+def fill_basket(user, lines):
+    order, _ = Order.objects.get_or_create(user=user, state=Order.States.CART)
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_info_id=pk, quantity=quantity) for pk, quantity in lines.items()
+    ])
+    return order
+
+
+class ConfirmOrderTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(3)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        ProductInfo.objects.filter(id__in=self.ids).update(quantity=5)
+        refresh_catalog_entries(self.ids)
+        self.user, self.contact = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def confirm(self):
+        return self.client.post("/order/confirm/", {"contact_id": self.contact.id})
+
+    def stock(self):
+        return list(ProductInfo.objects.order_by("id").values_list("quantity", flat=True))
+
+    def test_confirm_reserves_stock(self):
+        order = fill_basket(self.user, {self.ids[0]: 2, self.ids[1]: 5})
+
+        response = self.confirm()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["order_id"], order.id)
+        self.assertEqual(self.stock(), [3, 0, 5])
+        order.refresh_from_db()
+        self.assertEqual((order.state, order.contact_id), (Order.States.NEW, self.contact.id))
+
+    def test_catalog_follows_reserved_stock(self):
+        get_catalog_cache().clear()
+        fill_basket(self.user, {self.ids[0]: 2, self.ids[1]: 5})
+        in_stock = lambda: [row["id"] for row in self.client.get("/products/?in_stock=1").data["results"]]
+        self.assertEqual(in_stock(), self.ids)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.confirm()
+
+        self.assertEqual(in_stock(), [self.ids[0], self.ids[2]])
+        self.assertEqual(CatalogEntry.objects.get(pk=self.ids[0]).quantity, 3)
+        self.assertEqual(check_catalog(), {'missing': [], 'extra': [], 'stale': []})
+
+    def test_shortage_changes_nothing(self):
+        order = fill_basket(self.user, {self.ids[0]: 2, self.ids[1]: 6})
+
+        response = self.confirm()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["items"], [{"product_info": self.ids[1], "requested": 6, "available": 5}])
+        self.assertEqual(self.stock(), [5, 5, 5])
+        order.refresh_from_db()
+        self.assertEqual(order.state, Order.States.CART)
+
+    def test_empty_basket_and_foreign_contact(self):
+        self.assertEqual(self.confirm().status_code, 400)
+        fill_basket(self.user, {self.ids[0]: 1})
+        _, other_contact = make_buyer("other@example.com")
+        response = self.client.post("/order/confirm/", {"contact_id": other_contact.id})
+        self.assertEqual(response.status_code, 404)
+
+
+class ConcurrentConfirmTests(TransactionTestCase):
+    """Параллельные подтверждения не уводят остаток в минус"""
+
+    @mock.patch("backend.mail.wake_outbox")
+    def test_parallel_confirmations_do_not_oversell(self, wake_outbox):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(1)))
+        info = ProductInfo.objects.get()
+        ProductInfo.objects.filter(id=info.id).update(quantity=5)
+        buyers = [make_buyer(f"buyer{n}@example.com") for n in range(12)]
+        for user, _ in buyers:
+            fill_basket(user, {info.id: 1})
+
+        results = []
+        barrier = threading.Barrier(len(buyers))
+
+        def worker(user, contact):
+            barrier.wait()
+            try:
+                # SQLite блокирует базу целиком: занятая база - повод повторить, а не результат
+                for _ in range(500):
+                    try:
+                        confirm_order(user, contact)
+                        results.append("ok")
+                        return
+                    except OperationalError:
+                        time.sleep(0.01)
+            except OutOfStock:
+                results.append("out")
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=buyer) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count("ok"), 5)
+        self.assertEqual(results.count("out"), len(buyers) - 5)
+        self.assertEqual(ProductInfo.objects.get(id=info.id).quantity, 0)
+        self.assertEqual(Order.objects.filter(state=Order.States.NEW).count(), 5)
+
+
+class OrderTotalsTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(3, price=100)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        ProductInfo.objects.filter(id=self.ids[1]).update(price="19.99")
+        self.user, _ = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_totals_are_computed_in_sql(self):
+        fill_basket(self.user, {self.ids[0]: 2, self.ids[1]: 3})
+        order = Order.objects.with_totals().get(user=self.user)
+
+        self.assertEqual(order.total_sum, Decimal("259.97"))
+        with self.assertNumQueries(0):
+            self.assertEqual(order.total, Decimal("259.97"))
+        # без аннотации сумма тоже считается одним запросом
+        plain = Order.objects.get(user=self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(plain.total, Decimal("259.97"))
+
+    def test_empty_order_total_is_zero(self):
+        Order.objects.create(user=self.user)
+        self.assertEqual(Order.objects.with_totals().get(user=self.user).total_sum, 0)
+
+    def test_basket_and_history_totals(self):
+        order = fill_basket(self.user, {self.ids[0]: 1, self.ids[1]: 2})
+
+        response = self.client.get("/basket/")
+        self.assertEqual(response.data["total"], Decimal("139.98"))
+        self.assertEqual([item["total"] for item in response.data["items"]], [Decimal("100"), Decimal("39.98")])
+
+        Order.objects.filter(id=order.id).update(state=Order.States.NEW)
+        response = self.client.get("/orders/")
+        self.assertEqual(response.data["results"][0]["total"], Decimal("139.98"))
+
+
+class OrderHistoryTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(5)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        self.user, _ = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def place_orders(self, count):
+        for _ in range(count):
+            order = fill_basket(self.user, {pk: 1 for pk in self.ids[:3]})
+            Order.objects.filter(id=order.id).update(state=Order.States.NEW)
+
+    def test_query_count_does_not_grow_with_history(self):
+        counts = []
+        for count in (2, 30):
+            self.place_orders(count)
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get("/orders/", {"page_size": 100})
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(len(response.data["results"]), 32)
+        self.assertEqual(len(response.data["results"][0]["items"]), 3)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_pages_follow_created_at(self):
+        self.place_orders(5)
+        fill_basket(self.user, {self.ids[0]: 1})
+
+        seen = []
+        url = "/orders/?page_size=2"
+        while url:
+            response = self.client.get(url)
+            seen.extend(order["id"] for order in response.data["results"])
+            url = response.data["next"]
+
+        expected = Order.objects.exclude(state=Order.States.CART).order_by("-created_at", "-pk")
+        self.assertEqual(seen, list(expected.values_list("id", flat=True)))
+
+
+class OrderSnapshotTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(3)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        ProductInfo.objects.filter(id__in=self.ids).update(quantity=10)
+        self.user, self.contact = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_confirmed_order_keeps_prices(self):
+        order = fill_basket(self.user, {self.ids[0]: 2, self.ids[1]: 1})
+        confirm_order(self.user, self.contact)
+
+        ProductInfo.objects.filter(id__in=self.ids).update(price=999)
+        Product.objects.filter(items__id=self.ids[0]).update(name="Переименован")
+
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal("300"))
+        self.assertEqual(Order.objects.with_totals().get(id=order.id).total_sum, Decimal("300"))
+        line = order.items.get(product_info_id=self.ids[0])
+        self.assertEqual((line.price, line.product_name, line.shop_name), (Decimal("100"), "Товар 0", "Тестовый магазин"))
+
+        response = self.client.get("/orders/")
+        result = response.data["results"][0]
+        self.assertEqual(result["total"], Decimal("300"))
+        self.assertEqual(result["items"][0], {
+            "product": "Товар 0", "shop": "Тестовый магазин",
+            "quantity": 2, "price": Decimal("100"), "total": Decimal("200"),
+        })
+
+    def test_long_names_fit_snapshot(self):
+        name = "Магазин " + "с очень длинным названием " * 3
+        Shop.objects.update(name=name[:100])
+        fill_basket(self.user, {self.ids[0]: 1})
+
+        order = confirm_order(self.user, self.contact)
+
+        self.assertEqual(order.items.get().shop_name, name[:100])
+        # SQLite не проверяет длину строк: снимок должен вмещать любое допустимое название
+        for field, model in (("shop_name", Shop), ("product_name", Product)):
+            self.assertEqual(OrderItem._meta.get_field(field).max_length, model._meta.get_field("name").max_length)
+
+    def test_command_backfills_legacy_orders(self):
+        order = fill_basket(self.user, {self.ids[2]: 3})
+        Order.objects.filter(id=order.id).update(state=Order.States.NEW)
+
+        out = StringIO()
+        call_command("snapshot_orders", stdout=out)
+
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal("300"))
+        self.assertEqual(order.items.get().product_name, "Товар 2")
+        self.assertIn("Зафиксировано заказов: 1", out.getvalue())
+
+
+class CachedTokenAuthTests(TestCase):
+
+    def setUp(self):
+        get_auth_cache().clear()
+        self.user, _ = make_buyer("buyer@example.com")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def basket_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/basket/")
+        return response.status_code, len(ctx.captured_queries)
+
+    def test_repeated_requests_skip_token_lookup(self):
+        status, first = self.basket_queries()
+        self.assertEqual(status, 200)
+        status, second = self.basket_queries()
+        self.assertEqual(status, 200)
+        self.assertEqual(second, first - 1)
+
+    def test_deleted_token_is_rejected(self):
+        self.basket_queries()
+        self.token.delete()
+        self.assertEqual(self.basket_queries()[0], 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.basket_queries()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.basket_queries()[0], 401)
+
+    def test_unknown_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + "0" * 40)
+        self.assertEqual(self.basket_queries()[0], 401)
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=1000, LOGIN_ATTEMPTS_PER_EMAIL=3, LOGIN_ATTEMPTS_PER_IP=5)
+class LoginThrottlingTests(TestCase):
+
+    def setUp(self):
+        get_login_cache().clear()
+        self.user = User.objects.create_user(email="buyer@example.com", password="secret-pass", is_active=True)
+        self.client = APIClient()
+
+    def login(self, email="buyer@example.com", password="secret-pass", ip="198.51.100.1"):
+        return self.client.post("/login/", {"email": email, "password": password}, REMOTE_ADDR=ip)
+
+    def test_email_is_locked_after_failures(self):
+        for _ in range(3):
+            self.assertEqual(self.login(password="wrong").status_code, 400)
+        # даже верный пароль не проверяется, пока не истечёт окно
+        with mock.patch("django.contrib.auth.hashers.PBKDF2PasswordHasher.verify") as verify:
+            self.assertEqual(self.login().status_code, 429)
+            verify.assert_not_called()
+
+    def test_success_resets_email_counter(self):
+        for _ in range(2):
+            self.login(password="wrong")
+        self.assertEqual(self.login().status_code, 200)
+        for _ in range(2):
+            self.login(password="wrong")
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_ip_is_locked_across_emails(self):
+        for n in range(5):
+            self.login(email=f"guess{n}@example.com")
+        self.assertEqual(self.login().status_code, 429)
+        self.assertEqual(self.login(ip="198.51.100.2").status_code, 200)
+
+    def test_unknown_email_is_cached(self):
+        self.login(email="new@example.com")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.login(email="new@example.com").status_code, 400)
+
+        User.objects.create_user(email="new@example.com", password="secret-pass", is_active=True)
+        self.assertEqual(self.login(email="new@example.com").status_code, 200)
+
+    def test_email_case_is_ignored(self):
+        self.assertEqual(self.login(email=" Buyer@Example.COM").status_code, 200)
+        # неудачи под разным регистром считаются вместе
+        for email in ("BUYER@example.com", "buyer@EXAMPLE.com", "Buyer@example.com"):
+            self.login(email=email, password="wrong")
+        self.assertEqual(self.login().status_code, 429)
+
+    def test_email_is_stored_lowercase(self):
+        user = User.objects.create_user(email=" Mixed.Case@Example.COM ", password="secret-pass", is_active=True)
+        self.assertEqual(user.email, "mixed.case@example.com")
+
+        response = self.client.post("/register/", {"email": "MIXED.case@example.com", "password": "x"})
+        self.assertEqual(response.status_code, 400)
+
+        # вход ищет пользователя точным совпадением, без UPPER/LIKE по email
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.login(email="Mixed.Case@example.com").status_code, 200)
+        lookup = next(q["sql"] for q in ctx.captured_queries if '"email"' in q["sql"])
+        self.assertNotIn("LIKE", lookup.upper())
+        self.assertNotIn("UPPER", lookup.upper())
+
+    @override_settings(LOGIN_CLIENT_IP_HEADER="HTTP_X_FORWARDED_FOR", LOGIN_TRUSTED_PROXY_COUNT=1)
+    def test_client_ip_from_trusted_proxy_header(self):
+        def login(forwarded_for, email="guess@example.com"):
+            return self.client.post(
+                "/login/", {"email": email, "password": "x"},
+                REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR=forwarded_for,
+            )
+
+        # клиент подставляет свой адрес в начало, прокси дописывает настоящий
+        for n in range(5):
+            login(f"203.0.113.{n}, 198.51.100.7", email=f"guess{n}@example.com")
+        self.assertEqual(login("198.51.100.7").status_code, 429)
+        # другие клиенты за тем же прокси не заблокированы
+        self.assertEqual(self.login(ip="10.0.0.1").status_code, 200)
+
+    def test_benchmark_keeps_other_keys(self):
+        self.login(password="wrong")
+        call_command("bench_login", seconds=0.01, stdout=StringIO())
+
+        self.assertFalse(is_unknown_email("nobody@bench.invalid"))
+        # неудача покупателя, записанная до замера, не стёрта
+        for _ in range(2):
+            self.login(password="wrong")
+        self.assertEqual(self.login().status_code, 429)
+
+    def test_password_is_rehashed_on_login(self):
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$1000$"))
+        with override_settings(PASSWORD_PBKDF2_ITERATIONS=2000):
+            self.assertEqual(self.login().status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$2000$"))
+
+
+class EmailOutboxTests(TestCase):
+
+    def setUp(self):
+        from orders.celery import app
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", eager)
+
+    def test_registration_queues_confirmation(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = APIClient().post("/register/", {"email": "new@example.com", "password": "secret-pass"})
+
+        self.assertEqual(response.status_code, 200)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to, ["new@example.com"])
+        self.assertIn(ConfirmEmailToken.objects.get().key, email.body)
+        # в самом запросе ничего не отправляется
+        self.assertEqual(mail.outbox, [])
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Подтверждение регистрации")
+        email.refresh_from_db()
+        self.assertEqual(email.state, OutgoingEmail.States.SENT)
+
+    def test_batch_uses_one_connection(self):
+        for n in range(5):
+            queue_email(f"Письмо {n}", "Текст", [f"user{n}@example.com"])
+
+        with mock.patch("backend.mail.get_connection", wraps=mail.get_connection) as get_connection:
+            self.assertEqual(deliver_outbox(batch_size=2), (5, 0))
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(deliver_outbox(), (0, 0))
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2, EMAIL_OUTBOX_RETRY_DELAY=60)
+    def test_failures_are_retried_with_backoff(self):
+        email = queue_email("Письмо", "Текст", ["user@example.com"])
+
+        with mock.patch("django.core.mail.EmailMessage.send", side_effect=OSError("SMTP недоступен")):
+            self.assertEqual(deliver_outbox(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.state, email.attempts, email.last_error), ("pending", 1, "SMTP недоступен"))
+            self.assertGreater(email.next_attempt_at, email.created_at)
+            # следующая попытка только после паузы
+            self.assertEqual(deliver_outbox(), (0, 0))
+
+            OutgoingEmail.objects.update(next_attempt_at=email.created_at)
+            self.assertEqual(deliver_outbox(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.state, OutgoingEmail.States.FAILED)
+
+    def test_connection_failure_backs_off_whole_batch(self):
+        for n in range(3):
+            queue_email(f"Письмо {n}", "Текст", [f"user{n}@example.com"])
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.open", side_effect=OSError("Нет соединения")):
+            with self.assertLogs("backend.mail", "WARNING"):
+                self.assertEqual(deliver_outbox(), (0, 3))
+            self.assertEqual(deliver_outbox(), (0, 0))
+
+        rows = OutgoingEmail.objects.values_list("state", "attempts", "last_error")
+        self.assertEqual(set(rows), {("pending", 1, "Нет соединения")})
+        self.assertFalse(OutgoingEmail.objects.filter(next_attempt_at__lte=timezone.now()).exists())
+
+    def test_close_failure_keeps_sent_state(self):
+        queue_email("Письмо", "Текст", ["user@example.com"])
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.close", side_effect=OSError("QUIT")):
+            with self.assertLogs("backend.mail", "WARNING"):
+                self.assertEqual(deliver_outbox(), (1, 0))
+
+        self.assertEqual(OutgoingEmail.objects.get().state, OutgoingEmail.States.SENT)
+
+
+class OrderStateMachineTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(2)))
+            import_shop_from_yaml(write_feed(tmp, make_feed(1, shop="Чужой магазин"), "other.yaml"))
+        self.partner = User.objects.create_user(email="shop@example.com", type=User.Types.SHOP, is_active=True)
+        Shop.objects.filter(name="Тестовый магазин").update(user=self.partner)
+        self.ids = list(ProductInfo.objects.filter(shop__user=self.partner).order_by("id").values_list("id", flat=True))
+        self.foreign_id = ProductInfo.objects.get(shop__name="Чужой магазин").id
+        ProductInfo.objects.update(quantity=100)
+        refresh_catalog_entries(ProductInfo.objects.values_list("id", flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.partner)
+
+    def place_orders(self, count, lines=None):
+        orders = []
+        for n in range(count):
+            user, contact = make_buyer(f"buyer{Order.objects.count()}@example.com")
+            fill_basket(user, lines or {self.ids[0]: 1})
+            orders.append(confirm_order(user, contact).id)
+        return orders
+
+    def transition(self, orders, state):
+        return self.client.post("/partner/orders/state/", {"orders": orders, "state": state}, format="json")
+
+    def test_bulk_transition_records_history(self):
+        orders = self.place_orders(3)
+
+        response = self.transition(orders, Order.States.CONFIRMED)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["changed"], orders)
+        self.assertEqual(set(Order.objects.filter(id__in=orders).values_list("state", flat=True)), {"confirmed"})
+        buyer_id = Order.objects.get(id=orders[0]).user_id
+        history = OrderStateChange.objects.filter(order_id=orders[0]).values_list("from_state", "to_state", "changed_by")
+        self.assertEqual(list(history), [("cart", "new", buyer_id), ("new", "confirmed", self.partner.id)])
+
+    def test_query_count_does_not_grow_with_orders(self):
+        counts = []
+        for count in (2, 25):
+            orders = self.place_orders(count)
+            # часть заказов уже в другом статусе: по UPDATE на каждый исходный статус
+            Order.objects.filter(id=orders[0]).update(state=Order.States.CONFIRMED)
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.transition(orders, Order.States.CANCELED)
+            self.assertEqual(len(response.data["changed"]), count)
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_invalid_and_foreign_orders_are_reported(self):
+        new, delivered = self.place_orders(2)
+        Order.objects.filter(id=delivered).update(state=Order.States.DELIVERED)
+        foreign = self.place_orders(1, {self.foreign_id: 1})[0]
+
+        response = self.transition([new, delivered, foreign, 999999], Order.States.CONFIRMED)
+
+        self.assertEqual(response.data["changed"], [new])
+        self.assertEqual(response.data["skipped"], [{"id": delivered, "state": "delivered"}])
+        self.assertEqual(response.data["not_found"], [foreign, 999999])
+        self.assertEqual(Order.objects.get(id=foreign).state, Order.States.NEW)
+
+    def test_order_with_other_shop_lines_is_not_changed(self):
+        own, mixed = self.place_orders(1)[0], self.place_orders(1, {self.ids[0]: 1, self.foreign_id: 2})[0]
+
+        response = self.transition([own, mixed], Order.States.CANCELED)
+
+        self.assertEqual(response.data["changed"], [own])
+        self.assertEqual(response.data["shared"], [mixed])
+        self.assertEqual(response.data["not_found"], [])
+        self.assertEqual(Order.objects.get(id=mixed).state, Order.States.NEW)
+        self.assertEqual(ProductInfo.objects.get(id=self.foreign_id).quantity, 98)
+
+    def test_cancel_returns_stock(self):
+        orders = self.place_orders(2, {self.ids[0]: 3, self.ids[1]: 1})
+        self.assertEqual(ProductInfo.objects.get(id=self.ids[0]).quantity, 94)
+
+        self.transition(orders, Order.States.CANCELED)
+
+        self.assertEqual(ProductInfo.objects.get(id=self.ids[0]).quantity, 100)
+        self.assertEqual(ProductInfo.objects.get(id=self.ids[1]).quantity, 100)
+        self.assertEqual(CatalogEntry.objects.get(pk=self.ids[0]).quantity, 100)
+        self.assertEqual(check_catalog(), {'missing': [], 'extra': [], 'stale': []})
+
+    def test_rejects_bad_requests(self):
+        orders = self.place_orders(1)
+        self.assertEqual(self.transition(orders, "new").status_code, 400)
+        self.assertEqual(self.transition(orders, "unknown").status_code, 400)
+        self.assertEqual(self.transition([], "confirmed").status_code, 400)
+        buyer = Order.objects.get(id=orders[0]).user
+        self.client.force_authenticate(buyer)
+        self.assertEqual(self.transition(orders, "confirmed").status_code, 403)
+
+
+class PartnerOrdersTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(2)))
+            import_shop_from_yaml(write_feed(tmp, make_feed(1, shop="Чужой магазин", price=50), "other.yaml"))
+        self.partner = User.objects.create_user(email="shop@example.com", type=User.Types.SHOP, is_active=True)
+        Shop.objects.filter(name="Тестовый магазин").update(user=self.partner)
+        self.own = list(ProductInfo.objects.filter(shop__user=self.partner).order_by("id").values_list("id", flat=True))
+        self.foreign = ProductInfo.objects.get(shop__name="Чужой магазин").id
+        ProductInfo.objects.update(quantity=1000)
+        self.client = APIClient()
+        self.client.force_authenticate(self.partner)
+
+    def place_orders(self, count, lines):
+        orders = []
+        for _ in range(count):
+            user, contact = make_buyer(f"buyer{Order.objects.count()}@example.com")
+            fill_basket(user, lines)
+            orders.append(confirm_order(user, contact).id)
+        return orders
+
+    def test_only_own_lines_and_subtotals(self):
+        mixed = self.place_orders(1, {self.own[0]: 2, self.foreign: 1})[0]
+        self.place_orders(1, {self.foreign: 1})
+        cart_owner, _ = make_buyer("cart@example.com")
+        fill_basket(cart_owner, {self.own[1]: 1})
+
+        response = self.client.get("/partner/orders/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([order["id"] for order in response.data["results"]], [mixed])
+        order = response.data["results"][0]
+        self.assertEqual(order["subtotal"], Decimal("200"))
+        self.assertEqual([item["shop"] for item in order["items"]], ["Тестовый магазин"])
+
+    def test_query_count_and_pages(self):
+        counts = []
+        for count in (2, 20):
+            self.place_orders(count, {self.own[0]: 1, self.own[1]: 1, self.foreign: 1})
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get("/partner/orders/", {"page_size": 50})
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(len(response.data["results"]), 22)
+
+        seen = []
+        url = "/partner/orders/?page_size=5"
+        while url:
+            response = self.client.get(url)
+            seen.extend(order["id"] for order in response.data["results"])
+            url = response.data["next"]
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertEqual(len(seen), 22)
+
+    def test_state_filter_and_buyers_are_rejected(self):
+        first, second = self.place_orders(2, {self.own[0]: 1})
+        Order.objects.filter(id=first).update(state=Order.States.SENT)
+        response = self.client.get("/partner/orders/", {"state": "sent"})
+        self.assertEqual([order["id"] for order in response.data["results"]], [first])
+
+        self.client.force_authenticate(Order.objects.get(id=second).user)
+        self.assertEqual(self.client.get("/partner/orders/").status_code, 403)
+
+
+class IndexTests(TestCase):
+
+    def test_one_cart_per_user(self):
+        user, _ = make_buyer("buyer@example.com")
+        Order.objects.create(user=user)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(user=user)
+        # оформленных заказов может быть сколько угодно
+        Order.objects.create(user=user, state=Order.States.NEW)
+        Order.objects.create(user=user, state=Order.States.NEW)
+
+    def test_hot_queries_use_indexes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(3)))
+        make_buyer("buyer@example.com")
+
+        out = StringIO()
+        call_command("explain_queries", fail_on_scan=True, stdout=out)
+
+        for index in ("order_history_idx", "catalog_category_price_idx", "catalog_in_stock_idx"):
+            self.assertIn(index, out.getvalue())
+
+
+class CartServiceTests(TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(2)))
+        self.ids = list(ProductInfo.objects.order_by("id").values_list("id", flat=True))
+        self.user, _ = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_remove_only_touches_cart(self):
+        order = fill_basket(self.user, {self.ids[0]: 1})
+        Order.objects.filter(id=order.id).update(state=Order.States.NEW)
+        confirmed_line = order.items.get().id
+        cart = fill_basket(self.user, {self.ids[1]: 1})
+
+        self.client.post("/basket/remove/", {"order_item_id": confirmed_line})
+        self.client.post("/basket/remove/", {"order_item_id": cart.items.get().id})
+
+        self.assertTrue(OrderItem.objects.filter(id=confirmed_line).exists())
+        self.assertFalse(cart.items.exists())
+
+    def test_lost_insert_race_returns_existing_cart(self):
+        cart = Order.objects.create(user=self.user)
+        # первый поиск «не видит» корзину, созданную параллельным запросом
+        with mock.patch("backend.basket.find_cart_id", side_effect=[None, cart.id]):
+            self.assertEqual(get_or_create_cart_id(self.user), cart.id)
+        self.assertEqual(find_cart_id(self.user), cart.id)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+
+    def test_new_cart_after_confirmation(self):
+        add_to_basket(self.user, {self.ids[0]: 1})
+        Order.objects.filter(user=self.user).update(state=Order.States.NEW)
+        add_to_basket(self.user, {self.ids[1]: 2})
+
+        cart = Order.objects.get(user=self.user, state=Order.States.CART)
+        self.assertEqual(list(cart.items.values_list("product_info_id", "quantity")), [(self.ids[1], 2)])
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    """Параллельные добавления в пустую корзину создают одну корзину и не теряют строки"""
+
+    def test_parallel_adds_share_one_cart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            import_shop_from_yaml(write_feed(tmp, make_feed(9)))
+        shared, *own = ProductInfo.objects.order_by("id").values_list("id", flat=True)
+        user, _ = make_buyer("buyer@example.com")
+
+        barrier = threading.Barrier(len(own))
+        errors = []
+
+        def worker(product_info_id):
+            barrier.wait()
+            try:
+                # SQLite блокирует базу целиком: занятая база - повод повторить
+                for _ in range(500):
+                    try:
+                        add_to_basket(user, {shared: 1, product_info_id: 1})
+                        return
+                    except OperationalError:
+                        time.sleep(0.01)
+                errors.append(product_info_id)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(pk,)) for pk in own]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        cart = Order.objects.get(user=user)
+        lines = dict(cart.items.values_list("product_info_id", "quantity"))
+        self.assertEqual(lines, {shared: len(own), **{pk: 1 for pk in own}})
+
+
+class QueryMetricsTests(TestCase):
+
+    def setUp(self):
+        METRICS.clear()
+        self.user, _ = make_buyer("buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/orders/")
+
+        self.assertEqual(response["X-Query-Count"], str(len(ctx.captured_queries)))
+        self.assertEqual(response["X-Query-Duplicates"], "0")
+        self.assertIn("X-Response-Time-Ms", response)
+
+    def test_no_headers_without_debug(self):
+        self.assertNotIn("X-Query-Count", self.client.get("/orders/"))
+
+    def test_duplicate_statements_are_counted(self):
+        stats = QueryStats()
+        with connection.execute_wrapper(stats):
+            for user_id in (1, 2, 3):
+                list(User.objects.filter(id=user_id))
+            list(Order.objects.all())
+        self.assertEqual((stats.count, stats.duplicates), (4, 2))
+
+    def test_prometheus_endpoint(self):
+        self.client.get("/orders/")
+        self.client.get("/orders/")
+
+        response = self.client.get("/metrics/")
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('api_requests_total{view="order-list"} 2', body)
+        self.assertIn('api_request_duration_seconds_count{view="order-list"} 2', body)
+        self.assertIn('api_db_queries_total{view="order-list"}', body)
+        self.assertEqual(self.client.get("/metrics/", REMOTE_ADDR="203.0.113.5").status_code, 403)
+
+
+class BenchmarkCommandsTests(TestCase):
+
+    def test_generate_and_bench(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command(
+                "generate_benchmark_data", shops=2, skus=20, buyers=3, orders=15, out=tmp, stdout=StringIO(),
+            )
+            self.assertEqual(len(list(Path(tmp).glob("bench_shop_*.yaml"))), 2)
+            orders_before = Order.objects.count()
+
+            output = Path(tmp) / "bench.json"
+            call_command(
+                "bench_endpoints", requests=2, warmup=0, output=str(output),
+                stdout=StringIO(),
+            )
+            report = json.loads(output.read_text(encoding="utf-8"))
+
+        self.assertEqual(Order.objects.exclude(state=Order.States.CART).count(), 15)
+        # запросы на запись откатываются
+        self.assertEqual(Order.objects.count(), orders_before)
+        routes = report["routes"]
+        self.assertEqual(routes["admin"], {"skipped": "админка Django"})
+        for name in ("product-list", "order-list", "partner-orders", "confirm-order", "basket-batch"):
+            self.assertEqual(routes[name]["requests"], 2)
+            self.assertTrue(all(int(status) < 400 for status in routes[name]["statuses"]), (name, routes[name]))
+        self.assertEqual(report["meta"]["dataset"]["orders"], 15)
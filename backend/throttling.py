@@ -0,0 +1,90 @@
+"""
+Ограничение попыток входа.
+
+Неудачные попытки считаются в кэше LOGIN_CACHE отдельно по email и по IP
+в окне LOGIN_THROTTLE_WINDOW секунд. Когда лимит исчерпан, пароль даже не
+проверяется, поэтому перебор не нагружает процессор хешированием.
+Неизвестные email запоминаются на LOGIN_UNKNOWN_EMAIL_TIMEOUT секунд,
+чтобы повторные попытки не ходили в базу.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+FAILURES_KEY = "login:failures:{}:{}"
+UNKNOWN_EMAIL_KEY = "login:unknown:{}"
+
+
+def get_login_cache():
+    return caches[getattr(settings, "LOGIN_CACHE", "default")]
+
+
+def client_ip(request):
+    """
+    Адрес клиента: из заголовка LOGIN_CLIENT_IP_HEADER, если он задан и
+    пришёл, иначе REMOTE_ADDR. В X-Forwarded-For каждый прокси дописывает
+    адрес в конец, поэтому берётся адрес, записанный первым доверенным
+    прокси (LOGIN_TRUSTED_PROXY_COUNT с конца), а не подставленный клиентом.
+    """
+    if request is None:
+        return None
+    header = getattr(settings, "LOGIN_CLIENT_IP_HEADER", None)
+    if header:
+        addresses = [ip.strip() for ip in request.META.get(header, "").split(",") if ip.strip()]
+        proxies = getattr(settings, "LOGIN_TRUSTED_PROXY_COUNT", 1)
+        if len(addresses) >= proxies > 0:
+            return addresses[-proxies]
+    return request.META.get("REMOTE_ADDR")
+
+
+def _digest(value):
+    return hashlib.sha256(value.strip().lower().encode()).hexdigest()
+
+
+def _failure_keys(email, ip):
+    keys = {FAILURES_KEY.format("email", _digest(email)): getattr(settings, "LOGIN_ATTEMPTS_PER_EMAIL", 5)}
+    if ip:
+        keys[FAILURES_KEY.format("ip", _digest(ip))] = getattr(settings, "LOGIN_ATTEMPTS_PER_IP", 20)
+    return keys
+
+
+def login_throttled(email, ip):
+    """Исчерпан ли лимит неудачных попыток для email или IP"""
+    keys = _failure_keys(email, ip)
+    counts = get_login_cache().get_many(list(keys))
+    return any(counts.get(key, 0) >= limit for key, limit in keys.items())
+
+
+def register_failure(email, ip):
+    cache = get_login_cache()
+    window = getattr(settings, "LOGIN_THROTTLE_WINDOW", 300)
+    for key in _failure_keys(email, ip):
+        # окно фиксированное: отсчитывается от первой неудачи
+        cache.add(key, 0, timeout=window)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=window)
+
+
+def reset_failures(email):
+    get_login_cache().delete(FAILURES_KEY.format("email", _digest(email)))
+
+
+def is_unknown_email(email):
+    return get_login_cache().get(UNKNOWN_EMAIL_KEY.format(_digest(email)), False)
+
+
+def remember_unknown_email(email):
+    timeout = getattr(settings, "LOGIN_UNKNOWN_EMAIL_TIMEOUT", 60)
+    get_login_cache().set(UNKNOWN_EMAIL_KEY.format(_digest(email)), True, timeout=timeout)
+
+
+def forget_unknown_email(email):
+    get_login_cache().delete(UNKNOWN_EMAIL_KEY.format(_digest(email)))
+
+
+def forget_attempts(email, ip):
+    """Удаляет счётчики неудач для email и IP и отметку неизвестного email"""
+    get_login_cache().delete_many([*_failure_keys(email, ip), UNKNOWN_EMAIL_KEY.format(_digest(email))])
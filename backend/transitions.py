@@ -0,0 +1,54 @@
+"""Смена статусов заказов по графу Order.TRANSITIONS"""
+from django.db import transaction
+
+from .inventory import release_stock
+from .models import Order, OrderStateChange
+
+# Статусы, в которых остатки заказа списаны со склада, но товар ещё не отгружен
+RESERVED_STATES = {Order.States.NEW, Order.States.CONFIRMED, Order.States.ASSEMBLED}
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+def record_transitions(changes, user=None):
+    """Пишет историю одним INSERT; changes - [(order_id, from_state, to_state)]"""
+    OrderStateChange.objects.bulk_create([
+        OrderStateChange(order_id=order_id, from_state=source, to_state=target, changed_by=user)
+        for order_id, source, target in changes
+    ])
+
+
+@transaction.atomic
+def transition_orders(orders, target, user=None):
+    """
+    Переводит заказы из queryset orders в статус target.
+
+    Заказы группируются по текущему статусу, и для каждого допустимого
+    исходного статуса выполняется один UPDATE ... WHERE state = source,
+    поэтому число запросов не зависит от числа заказов. Возвращает
+    (переведённые id, {id: статус} для заказов, которые перевести нельзя).
+    """
+    if target not in Order.States.values or target == Order.States.NEW:
+        raise InvalidTransition(f"Нельзя перевести заказ в статус {target!r}")
+
+    current = dict(orders.select_for_update().order_by("id").values_list("id", "state"))
+    by_source = {}
+    skipped = {}
+    for pk, state in current.items():
+        if target in Order.TRANSITIONS[state]:
+            by_source.setdefault(state, []).append(pk)
+        else:
+            skipped[pk] = state
+
+    changed = []
+    for source, ids in by_source.items():
+        # условие по исходному статусу защищает от параллельной смены статуса
+        Order.objects.filter(id__in=ids, state=source).update(state=target)
+        changed.extend((pk, source, target) for pk in ids)
+
+    if target == Order.States.CANCELED:
+        release_stock([pk for pk, source, _ in changed if source in RESERVED_STATES])
+    record_transitions(changed, user)
+    return sorted(pk for pk, _, _ in changed), skipped
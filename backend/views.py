@@ -1,16 +1,32 @@
+from decimal import Decimal, InvalidOperation
+
 from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
 from rest_framework.permissions import IsAuthenticated
-from django.db.models import Sum, F
+from django.db.models import Exists, OuterRef, Prefetch, Sum, F
 from rest_framework.decorators import api_view, permission_classes
 from .models import (
     User, Shop, Category, Product, ProductInfo, Parameter,
-    ProductParameter, Contact, Order, OrderItem, ConfirmEmailToken
+    ProductParameter, Contact, Order, OrderItem, ConfirmEmailToken, ImportJob, CatalogEntry
 )
+from .basket import add_to_basket, parse_items, request_cart_id
+from .cache import catalog_cache_key, get_cached_page, set_cached_page
+from .checkout import EmptyBasket, confirm_order
+from .facets import filter_by_params, live_facets, parse_param_filters, stored_facets
+from .inventory import OutOfStock
+from .mail import queue_email
+from .pagination import KeysetPagination, OrderHistoryPagination
+from .search import search_catalog
+from .tasks import do_import
+from .throttling import client_ip, login_throttled
+from .transitions import InvalidTransition, transition_orders
 from rest_framework.authtoken.models import Token
 
 
@@ -26,17 +42,30 @@ class RegisterView(APIView):
         if not email or not password:
             return Response({"error": "Email и пароль обязательны"}, status=400)
 
+        email = User.objects.normalize_email(email)
         if User.objects.filter(email=email).exists():
             return Response({"error": "Пользователь уже существует"}, status=400)
 
-        user = User.objects.create_user(email=email, password=password, type=type)
-        return Response({"message": "Пользователь зарегистрирован"})
+        with transaction.atomic():
+            user = User.objects.create_user(email=email, password=password, type=type)
+            token = ConfirmEmailToken.objects.create(user=user)
+            # письмо уходит через очередь: регистрация не ждёт почтовый сервер
+            queue_email(
+                subject="Подтверждение регистрации",
+                body=f"Ваш токен подтверждения: {token.key}",
+                to=[email],
+            )
+
+        return Response({"message": "Пользователь зарегистрирован. Проверьте email."})
 
 class LoginView(APIView):
     def post(self, request):
         email = request.data.get("email")
         password = request.data.get("password")
 
+        if email and login_throttled(email, client_ip(request)):
+            return Response({"error": "Слишком много попыток входа, попробуйте позже"}, status=429)
+
         user = authenticate(request, email=email, password=password)
         if user is None:
             return Response({"error": "Неверные учетные данные"}, status=400)
@@ -49,46 +78,141 @@ class LoginView(APIView):
             "token": token.key
         })
 
+def parse_price(value):
+    # Decimal принимает Infinity и NaN, а СУБД падает на них уже при выполнении запроса
+    price = Decimal(value)
+    if not price.is_finite():
+        raise ValueError(value)
+    return price
+
+def filter_products(queryset, params):
+    """Фильтры каталога: shop, category, price_min, price_max, in_stock"""
+    if params.get("shop"):
+        queryset = queryset.filter(shop_id=int(params["shop"]))
+    if params.get("category"):
+        queryset = queryset.filter(category_id=int(params["category"]))
+    if params.get("price_min"):
+        queryset = queryset.filter(price__gte=parse_price(params["price_min"]))
+    if params.get("price_max"):
+        queryset = queryset.filter(price__lte=parse_price(params["price_max"]))
+    if params.get("in_stock"):
+        if params["in_stock"].lower() in ("1", "true", "yes"):
+            queryset = queryset.filter(quantity__gt=0)
+        else:
+            queryset = queryset.filter(quantity=0)
+    return queryset
+
+CATALOG_FIELDS = ('pk', 'name', 'shop_name', 'price', 'quantity', 'model', 'parameters')
+
+def serialize_catalog(rows):
+    return [
+        {
+            "id": row["pk"],
+            "name": row["name"],
+            "shop": row["shop_name"],
+            "price": row["price"],
+            "quantity": row["quantity"],
+            "model": row["model"],
+            "parameters": row["parameters"]
+        }
+        for row in rows
+    ]
+
 class ProductListView(APIView):
     def get(self, request):
-        products = ProductInfo.objects.select_related('product', 'shop').all()
-        data = [
-            {
-                "id": p.id,
-                "name": p.product.name,
-                "shop": p.shop.name,
-                "price": p.price,
-                "quantity": p.quantity,
-                "model": p.model,
-                "parameters": {
-                    param.parameter.name: param.value
-                    for param in p.parameters.all()
-                }
-            }
-            for p in products
-        ]
+        # ключ с версией каталога берётся до чтения базы
+        cache_key = catalog_cache_key(request)
+        cached = get_cached_page(cache_key)
+        if cached is not None:
+            return Response(cached)
+
+        try:
+            products = filter_products(CatalogEntry.objects.all(), request.query_params)
+        except (ValueError, InvalidOperation):
+            return Response({"error": "Неверные параметры фильтра"}, status=400)
+
+        # Карточки товаров уже собраны в CatalogEntry: одна таблица, без JOIN
+        paginator = KeysetPagination()
+        rows = paginator.paginate_queryset(products.values(*CATALOG_FIELDS), request)
+
+        response = paginator.get_paginated_response(serialize_catalog(rows))
+        set_cached_page(cache_key, response.data)
+        return response
+
+class ProductFacetView(APIView):
+    def get(self, request):
+        cache_key = catalog_cache_key(request)
+        cached = get_cached_page(cache_key)
+        if cached is not None:
+            return Response(cached)
+
+        params = request.query_params
+        try:
+            products = filter_products(CatalogEntry.objects.all(), params)
+            category_id = int(params["category"]) if params.get("category") else None
+        except (ValueError, InvalidOperation):
+            return Response({"error": "Неверные параметры фильтра"}, status=400)
+        selected = parse_param_filters(params)
+
+        paginator = KeysetPagination()
+        rows = paginator.paginate_queryset(filter_by_params(products, selected).values(*CATALOG_FIELDS), request)
+
+        # Без фильтров, кроме категории, счётчики берутся из предрассчитанной таблицы
+        if selected or any(params.get(key) for key in ("shop", "price_min", "price_max", "in_stock")):
+            facets = live_facets(products, selected)
+        else:
+            facets = stored_facets(category_id)
+
+        response = paginator.get_paginated_response(serialize_catalog(rows))
+        response.data["facets"] = facets
+        set_cached_page(cache_key, response.data)
+        return response
+
+class ProductSearchView(APIView):
+    def get(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response({"error": "Не указан запрос q"}, status=400)
+
+        cache_key = catalog_cache_key(request)
+        cached = get_cached_page(cache_key)
+        if cached is not None:
+            return Response(cached)
+
+        try:
+            products = filter_products(CatalogEntry.objects.all(), request.query_params)
+            limit = min(int(request.query_params.get("limit", 50)), 100)
+        except (ValueError, InvalidOperation):
+            return Response({"error": "Неверные параметры фильтра"}, status=400)
+
+        ids = search_catalog(products, query, limit=limit)
+        rows = {row["pk"]: row for row in CatalogEntry.objects.filter(pk__in=ids).values(*CATALOG_FIELDS)}
+        data = {"results": serialize_catalog(rows[pk] for pk in ids if pk in rows)}
+        set_cached_page(cache_key, data)
         return Response(data)
 
 class BasketView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        order = Order.objects.filter(user=request.user, state=Order.States.CART).first()
-        if not order:
+        cart_id = request_cart_id(request)
+        if cart_id is None:
             return Response({"items": [], "total": 0})
 
-        items = order.items.select_related('product_info__product', 'product_info__shop')
+        items = OrderItem.objects.filter(order_id=cart_id).with_totals().select_related(
+            'product_info__product', 'product_info__shop'
+        ).order_by('id')
         data = [
             {
                 "product": item.product_info.product.name,
                 "shop": item.product_info.shop.name,
                 "quantity": item.quantity,
                 "price": item.product_info.price,
-                "total": item.total
+                "total": item.line_total
             }
             for item in items
         ]
-        return Response({"items": data, "total": order.total})
+        return Response({"items": data, "total": sum((item["total"] for item in data), Decimal(0))})
 
 class BasketAddView(APIView):
     permission_classes = [IsAuthenticated]
@@ -96,36 +220,45 @@ class BasketAddView(APIView):
     def post(self, request):
 
         product_info_id = request.data.get("product_info")
-        quantity = int(request.data.get("quantity", 1))
-
         if not product_info_id:
             return Response({"error": "Не указан product_info"}, status=400)
 
         try:
-            product_info = ProductInfo.objects.get(id=product_info_id)
+            quantities = parse_items([{"product_info": product_info_id, "quantity": request.data.get("quantity", 1)}])
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        try:
+            add_to_basket(request.user, quantities, request_cart_id(request))
         except ProductInfo.DoesNotExist:
             return Response({"error": f"Товар с id={product_info_id} не найден"}, status=404)
 
-        order, _ = Order.objects.get_or_create(user=request.user, state=Order.States.CART)
-        product_info = ProductInfo.objects.get(id=product_info_id)
+        return Response({"message": "Товар добавлен в корзину"})
 
-        order_item, created = OrderItem.objects.get_or_create(
-            order=order,
-            product_info=product_info,
-            defaults={"quantity": quantity}
-        )
-        if not created:
-            order_item.quantity += quantity
-            order_item.save()
+class BasketBatchView(APIView):
+    permission_classes = [IsAuthenticated]
 
-        return Response({"message": "Товар добавлен в корзину"})
+    def post(self, request):
+        try:
+            quantities = parse_items(request.data.get("items"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        # Вся корзина синхронизируется одним запросом и одной транзакцией
+        try:
+            created, updated = add_to_basket(request.user, quantities, request_cart_id(request))
+        except ProductInfo.DoesNotExist as e:
+            return Response({"error": str(e)}, status=404)
+
+        return Response({"message": "Корзина обновлена", "created": created, "updated": updated})
 
 class BasketRemoveView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
         item_id = request.data.get("order_item_id")
-        OrderItem.objects.filter(id=item_id, order__user=request.user).delete()
+        # удалять можно только из корзины, а не из оформленных заказов
+        OrderItem.objects.filter(id=item_id, order_id=request_cart_id(request)).delete()
         return Response({"message": "Товар удален из корзины"})
 
 class ContactView(APIView):
@@ -165,34 +298,58 @@ class ConfirmOrderView(APIView):
 
     def post(self, request):
         contact_id = request.data.get("contact_id")
-        contact = Contact.objects.get(id=contact_id, user=request.user)
-        order = Order.objects.filter(user=request.user, state=Order.States.CART).first()
-        if not order:
-            return Response({"error": "Корзина пуста"}, status=400)
+        contact = Contact.objects.filter(id=contact_id, user=request.user).first()
+        if not contact:
+            return Response({"error": "Контакт не найден"}, status=404)
 
-        order.contact = contact
-        order.state = Order.States.NEW
-        order.save()
+        try:
+            order = confirm_order(request.user, contact)
+        except EmptyBasket:
+            return Response({"error": "Корзина пуста"}, status=400)
+        except OutOfStock as e:
+            return Response({"error": str(e), "items": e.shortages}, status=409)
 
         return Response({"message": "Заказ подтвержден", "order_id": order.id})
 
+def serialize_order_item(item):
+    """Строка заказа из снимка; заказы, подтверждённые до появления снимков, читают каталог"""
+    if item.price is None:
+        info = item.product_info
+        return {
+            "product": info.product.name,
+            "shop": info.shop.name,
+            "quantity": item.quantity,
+            "price": info.price,
+            "total": item.total
+        }
+    return {
+        "product": item.product_name,
+        "shop": item.shop_name,
+        "quantity": item.quantity,
+        "price": item.price,
+        "total": item.total
+    }
+
 class OrderListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        orders = Order.objects.filter(user=request.user).exclude(state=Order.States.CART)
+        # История читается из снимков в строках заказа. Заказы, подтверждённые
+        # до появления снимков, берут цену и названия из каталога, поэтому строки
+        # страницы приходят одним запросом вместе с товаром и магазином, а суммы
+        # считаются в базе
+        items = OrderItem.objects.with_totals().select_related(
+            'product_info__product', 'product_info__shop'
+        ).order_by('id')
+        orders = Order.objects.with_totals().filter(user=request.user).exclude(
+            state=Order.States.CART
+        ).prefetch_related(Prefetch('items', queryset=items))
+
+        paginator = OrderHistoryPagination()
+        page = paginator.paginate_queryset(orders, request)
         data = []
-        for order in orders:
-            items = [
-                {
-                    "product": item.product_info.product.name,
-                    "shop": item.product_info.shop.name,
-                    "quantity": item.quantity,
-                    "price": item.product_info.price,
-                    "total": item.total
-                }
-                for item in order.items.all()
-            ]
+        for order in page:
+            items = [serialize_order_item(item) for item in order.items.all()]
             data.append({
                 "id": order.id,
                 "created": order.created_at,
@@ -201,31 +358,127 @@ class OrderListView(APIView):
                 "items": items
             })
 
-        return Response(data)
+        return paginator.get_paginated_response(data)
 
+class PartnerUpdateView(APIView):
+    permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        if not request.user.is_shop:
+            return Response({"error": "Только для магазинов"}, status=403)
 
-    class RegisterView(APIView):
-        def post(self, request):
-            email = request.data.get("email")
-            password = request.data.get("password")
-            type = request.data.get("type", User.Types.BUYER)
+        url = request.data.get("url")
+        if not url:
+            return Response({"error": "Не указан url"}, status=400)
+        try:
+            URLValidator()(url)
+        except ValidationError as e:
+            return Response({"error": e.messages}, status=400)
 
-            if not email or not password:
-                return Response({"error": "Email и пароль обязательны"}, status=400)
+        # Импорт уходит в Celery, запрос не ждёт скачивания и записи прайса
+        job = ImportJob.objects.create(user=request.user, url=url)
+        transaction.on_commit(lambda: do_import.delay(job.id))
 
-            if User.objects.filter(email=email).exists():
-                return Response({"error": "Пользователь уже существует"}, status=400)
+        return Response({"message": "Импорт поставлен в очередь", "job_id": job.id}, status=202)
 
-            user = User.objects.create_user(email=email, password=password, type=type)
-            token = ConfirmEmailToken.objects.create(user=user)
+class ImportJobView(APIView):
+    permission_classes = [IsAuthenticated]
 
-            # Отправляем email (тестовый)
-            send_mail(
-                subject="Подтверждение регистрации",
-                message=f"Ваш токен подтверждения: {token.key}",
-                from_email="no-reply@shop.com",
-                recipient_list=[email],
-            )
+    def get(self, request, pk):
+        job = ImportJob.objects.filter(id=pk, user=request.user).first()
+        if not job:
+            return Response({"error": "Задача не найдена"}, status=404)
+
+        return Response({
+            "id": job.id,
+            "url": job.url,
+            "state": job.state,
+            "progress": job.progress,
+            "stats": job.stats,
+            "error": job.error,
+            "created": job.created_at,
+            "finished": job.finished_at
+        })
+
+class PartnerOrderStateView(APIView):
+    """Массовая смена статуса заказов с товарами магазина партнёра"""
+    permission_classes = [IsAuthenticated]
+    max_orders = 1000
+
+    def post(self, request):
+        if not request.user.is_shop:
+            return Response({"error": "Только для магазинов"}, status=403)
+
+        ids = request.data.get("orders")
+        state = request.data.get("state")
+        if not isinstance(ids, list) or not ids:
+            return Response({"error": "Передайте список id заказов в orders"}, status=400)
+        if len(ids) > self.max_orders:
+            return Response({"error": f"Не больше {self.max_orders} заказов за запрос"}, status=400)
+        try:
+            ids = {int(pk) for pk in ids}
+        except (TypeError, ValueError):
+            return Response({"error": "id заказов должны быть числами"}, status=400)
+
+        # партнёр меняет статус только заказов, все строки которых из его магазинов:
+        # заказ с товарами других магазинов общий, и один партнёр его не двигает
+        owned = OrderItem.objects.filter(order_id__in=ids, product_info__shop__user=request.user)
+        foreign = OrderItem.objects.filter(order_id__in=ids).exclude(product_info__shop__user=request.user)
+        shared = set(owned.filter(order_id__in=foreign.values("order_id")).values_list("order_id", flat=True))
+        orders = Order.objects.filter(id__in=owned.values("order_id")).exclude(id__in=shared)
+        try:
+            changed, skipped = transition_orders(orders, state, user=request.user)
+        except InvalidTransition as e:
+            return Response({"error": str(e)}, status=400)
+
+        found = set(changed) | skipped.keys() | shared
+        return Response({
+            "changed": changed,
+            "skipped": [{"id": pk, "state": skipped[pk]} for pk in sorted(skipped)],
+            "shared": sorted(shared),
+            "not_found": sorted(ids - found)
+        })
+
+class PartnerOrdersView(APIView):
+    """
+    Заказы с товарами магазинов партнёра: только его строки и подытог по ним.
+
+    Страница заказов выбирается полусоединением EXISTS по строкам магазина
+    (без DISTINCT по многотабличному JOIN), строки страницы - вторым запросом.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if not request.user.is_shop:
+            return Response({"error": "Только для магазинов"}, status=403)
+
+        shop_ids = list(Shop.objects.filter(user=request.user).values_list("id", flat=True))
+        shop_items = OrderItem.objects.filter(product_info__shop_id__in=shop_ids)
+        orders = Order.objects.filter(
+            Exists(shop_items.filter(order=OuterRef("pk")))
+        ).exclude(state=Order.States.CART).only("id", "created_at", "state")
+        if request.query_params.get("state"):
+            orders = orders.filter(state=request.query_params["state"])
+
+        paginator = OrderHistoryPagination()
+        page = paginator.paginate_queryset(orders, request)
+
+        lines = {}
+        items = shop_items.filter(order_id__in=[order.id for order in page]).with_totals().select_related(
+            "product_info__product", "product_info__shop"
+        ).order_by("id")
+        for item in items:
+            lines.setdefault(item.order_id, []).append(item)
+
+        data = []
+        for order in page:
+            order_lines = lines.get(order.id, [])
+            data.append({
+                "id": order.id,
+                "created": order.created_at,
+                "state": order.get_state_display(),
+                "subtotal": sum((item.line_total for item in order_lines), Decimal(0)),
+                "items": [serialize_order_item(item) for item in order_lines]
+            })
 
-            return Response({"message": "Пользователь зарегистрирован. Проверьте email."})
+        return paginator.get_paginated_response(data)
@@ -0,0 +1,91 @@
+"""Потоковое чтение прайсов поставщиков в формате shop1.yaml"""
+from yaml.events import (
+    AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent,
+    SequenceEndEvent, SequenceStartEvent, StreamEndEvent,
+)
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+try:
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    from yaml import SafeLoader as FeedLoader
+
+# Ключ прайса, значения которого отдаются по одному элементу
+STREAMED_KEY = "goods"
+
+
+def _resolve_tag(loader, kind, event, value=None):
+    if event.tag is None or event.tag == "!":
+        return loader.resolve(kind, value, event.implicit)
+    return event.tag
+
+
+def _compose(loader, anchors):
+    """Собирает узел YAML из потока событий (аналог Composer.compose_node)"""
+    event = loader.get_event()
+    if isinstance(event, AliasEvent):
+        if event.anchor not in anchors:
+            raise ValueError(f"Неизвестный якорь {event.anchor!r}")
+        return anchors[event.anchor]
+
+    if isinstance(event, ScalarEvent):
+        tag = _resolve_tag(loader, ScalarNode, event, event.value)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+        if event.anchor:
+            anchors[event.anchor] = node
+        return node
+
+    if isinstance(event, SequenceStartEvent):
+        tag = _resolve_tag(loader, SequenceNode, event)
+        node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        if event.anchor:
+            anchors[event.anchor] = node
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(_compose(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    if isinstance(event, MappingStartEvent):
+        tag = _resolve_tag(loader, MappingNode, event)
+        node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        if event.anchor:
+            anchors[event.anchor] = node
+        while not loader.check_event(MappingEndEvent):
+            key = _compose(loader, anchors)
+            node.value.append((key, _compose(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+        return node
+
+    raise ValueError(f"Неожиданное событие YAML: {event}")
+
+
+def iter_feed(stream):
+    """
+    Читает прайс по событиям парсера и выдаёт пары (ключ, значение).
+
+    Секции shop и categories отдаются целиком, а каждый элемент goods -
+    отдельной парой ('goods', item), поэтому в памяти держится только
+    текущий товар, а не всё дерево документа.
+    """
+    loader = FeedLoader(stream)
+    try:
+        loader.get_event()  # StreamStartEvent
+        if loader.check_event(StreamEndEvent):
+            return
+        loader.get_event()  # DocumentStartEvent
+        if not loader.check_event(MappingStartEvent):
+            raise ValueError("Прайс должен быть YAML-словарём")
+        loader.get_event()
+
+        anchors = {}
+        while not loader.check_event(MappingEndEvent):
+            key = loader.construct_document(_compose(loader, anchors))
+            if key == STREAMED_KEY and loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(SequenceEndEvent):
+                    yield key, loader.construct_document(_compose(loader, anchors))
+                loader.get_event()
+            else:
+                yield key, loader.construct_document(_compose(loader, anchors))
+    finally:
+        loader.dispose()
@@ -1,57 +1,376 @@
-import yaml
-from pathlib import Path
-from django.db import transaction
+import hashlib
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from backend.cache import bump_catalog_version
+from backend.catalog import refresh_catalog_entries
+from backend.facets import refresh_facets
 from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
+from backend.search import is_postgresql
+from data.feed import iter_feed
 
-def load_yaml(path):
-    with open(path, encoding="utf-8") as f:
-        return yaml.safe_load(f)
+# Сколько товаров записывается за один проход bulk-операций
+BATCH_SIZE = 1000
+
+# Поля ProductInfo, которые перезаписываются при повторном импорте
+PRODUCT_INFO_FIELDS = ["product", "model", "quantity", "price", "price_rrc", "fingerprint"]
+
+# Ключ advisory-блокировки PostgreSQL на создание общих строк каталога
+SHARED_ROWS_LOCK = 7_342_001
 
-@transaction.atomic
-def import_shop_from_yaml(yaml_path):
-    data = load_yaml(yaml_path)
 
-    shop_name = data.get("shop")
-    categories = data.get("categories", [])
-    goods = data.get("goods", [])
+def feed_fingerprint(item):
+    """Отпечаток содержимого товара из прайса: совпадает - строку можно не трогать"""
+    payload = [
+        item["name"],
+        item["category"],
+        str(item["price"]),
+        str(item["price_rrc"]),
+        item.get("quantity", 0),
+        item.get("model", ""),
+        sorted((name, str(value)) for name, value in item.get("parameters", {}).items()),
+    ]
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
 
-    # 1. Создаём магазин
-    shop, _ = Shop.objects.get_or_create(name=shop_name)
 
-    # 2. Создаём категории и связываем с магазином
-    for cat_data in categories:
-        category, _ = Category.objects.get_or_create(id=cat_data["id"], defaults={"name": cat_data["name"]})
-        category.shops.add(shop)
+def lock_shared_rows():
+    """
+    Даёт создавать общие для магазинов строки (категории, продукты,
+    характеристики) только одному импорту за раз.
 
-    # 3. Обрабатываем товары
-    for item in goods:
-        category = Category.objects.get(id=item["category"])
+    Обычно общие строки создаёт prepare_shared_rows короткими транзакциями,
+    и блокировка держится доли секунды. В транзакции импорта магазина она
+    нужна, только если строки не оказалось (прайс с categories после goods):
+    незакоммиченные вставки держат ключи уникальных индексов до конца
+    транзакции, и два импорта иначе могли бы ждать друг друга.
+    SQLite и так пишет в базу по одному.
+    """
+    if is_postgresql():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [SHARED_ROWS_LOCK])
 
-        product, _ = Product.objects.get_or_create(
-            name=item["name"],
-            category=category
+
+def create_categories(categories):
+    """Создаёт недостающие категории (общие для всех магазинов)"""
+    names = {cat["id"]: cat["name"] for cat in categories}
+    existing = set(Category.objects.filter(id__in=names).values_list("id", flat=True))
+    if existing != names.keys():
+        # Параллельный импорт другого магазина мог создать ту же категорию
+        # после нашего чтения: конфликт игнорируется
+        lock_shared_rows()
+        Category.objects.bulk_create(
+            [Category(id=pk, name=names[pk]) for pk in sorted(names) if pk not in existing],
+            ignore_conflicts=True,
         )
+    return names
+
+
+def import_categories(shop, categories):
+    """Создаёт недостающие категории и привязывает их к магазину"""
+    if not categories:
+        return
 
-        product_info, created = ProductInfo.objects.update_or_create(
-            product=product,
-            shop=shop,
-            external_id=item["id"],
-            defaults={
-                "model": item.get("model", ""),
-                "quantity": item.get("quantity", 0),
-                "price": item["price"],
-                "price_rrc": item["price_rrc"]
-            }
+    names = create_categories(categories)
+    ShopCategory = Category.shops.through
+    linked = set(
+        ShopCategory.objects.filter(shop_id=shop.id, category_id__in=names).values_list("category_id", flat=True)
+    )
+    if linked != names.keys():
+        ShopCategory.objects.bulk_create(
+            [ShopCategory(category_id=pk, shop_id=shop.id) for pk in names if pk not in linked],
+            ignore_conflicts=True,
         )
 
-        # 4. Параметры
+
+def check_categories(goods, known_ids):
+    """Проверяет, что все категории товаров существуют (один запрос на пачку)"""
+    unknown = {item["category"] for item in goods} - known_ids
+    if unknown:
+        known_ids.update(Category.objects.filter(id__in=unknown).values_list("id", flat=True))
+        missing = unknown - known_ids
+        if missing:
+            raise Category.DoesNotExist(f"Категории не найдены: {sorted(missing)}")
+
+
+def resolve_products(goods):
+    """Возвращает {(name, category_id): product_id}, создавая недостающие продукты"""
+    keys = {(item["name"], item["category"]) for item in goods}
+
+    def fetch():
+        rows = Product.objects.filter(
+            name__in={name for name, _ in keys},
+            category_id__in={category_id for _, category_id in keys},
+        ).values_list("name", "category_id", "id")
+        return {(name, category_id): pk for name, category_id, pk in rows if (name, category_id) in keys}
+
+    products = fetch()
+    missing = keys - products.keys()
+    if missing:
+        lock_shared_rows()
+        Product.objects.bulk_create(
+            [Product(name=name, category_id=category_id) for name, category_id in sorted(missing)],
+            ignore_conflicts=True,
+        )
+        products = fetch()
+    return products
+
+
+def resolve_parameters(names):
+    """Возвращает {name: parameter_id}, создавая недостающие характеристики"""
+    parameters = dict(Parameter.objects.filter(name__in=names).values_list("name", "id"))
+    missing = set(names) - parameters.keys()
+    if missing:
+        lock_shared_rows()
+        Parameter.objects.bulk_create(
+            [Parameter(name=name) for name in sorted(missing)], ignore_conflicts=True
+        )
+        parameters = dict(Parameter.objects.filter(name__in=names).values_list("name", "id"))
+    return parameters
+
+
+def sync_parameters(info_ids, goods_by_info, parameters):
+    """Приводит характеристики изменённых товаров к прайсу, не трогая совпадающие"""
+    existing = {
+        (info_id, parameter_id): (pk, value)
+        for pk, info_id, parameter_id, value in ProductParameter.objects.filter(
+            product_info_id__in=info_ids
+        ).values_list("id", "product_info_id", "parameter_id", "value")
+    }
+
+    changed = []
+    for info_id, item in goods_by_info.items():
         for param_name, param_value in item.get("parameters", {}).items():
-            parameter, _ = Parameter.objects.get_or_create(name=param_name)
-            ProductParameter.objects.update_or_create(
-                product_info=product_info,
-                parameter=parameter,
-                defaults={"value": str(param_value)}
+            key = (info_id, parameters[param_name])
+            value = str(param_value)
+            current = existing.pop(key, None)
+            if current is None or current[1] != value:
+                changed.append(ProductParameter(product_info_id=key[0], parameter_id=key[1], value=value))
+
+    if changed:
+        ProductParameter.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=["product_info", "parameter"],
+            update_fields=["value"],
+        )
+    # В existing остались характеристики, которых больше нет в прайсе
+    stale = [pk for pk, _ in existing.values()]
+    if stale:
+        # Без сигналов post_delete: каталог и фасеты пачки пересчитываются один раз
+        # после импорта, а сигнал пересчитывал бы их на каждую строку
+        stale_rows = ProductParameter.objects.filter(id__in=stale)
+        stale_rows._raw_delete(stale_rows.db)
+    return len(changed), len(stale)
+
+
+def import_goods_batch(shop, goods, known_categories, full=False):
+    """
+    Записывает пачку товаров фиксированным числом запросов.
+
+    Товары сверяются с сохранёнными отпечатками по (shop, external_id),
+    и в базу пишутся только изменившиеся. full=True пишет всю пачку.
+    """
+    # Один товар на external_id: последний в прайсе побеждает
+    by_external_id = {item["id"]: item for item in goods}
+    fingerprints = {external_id: feed_fingerprint(item) for external_id, item in by_external_id.items()}
+
+    if not full:
+        stored = dict(
+            ProductInfo.objects.filter(shop=shop, external_id__in=by_external_id)
+            .values_list("external_id", "fingerprint")
+        )
+        by_external_id = {
+            external_id: item for external_id, item in by_external_id.items()
+            if stored.get(external_id) != fingerprints[external_id]
+        }
+    stats = {"goods": 0, "unchanged": len(fingerprints) - len(by_external_id), "parameters": 0, "removed": 0}
+    if not by_external_id:
+        return stats
+
+    changed = list(by_external_id.values())
+    check_categories(changed, known_categories)
+    products = resolve_products(changed)
+
+    ProductInfo.objects.bulk_create(
+        [
+            ProductInfo(
+                product_id=products[(item["name"], item["category"])],
+                shop_id=shop.id,
+                external_id=external_id,
+                model=item.get("model", ""),
+                quantity=item.get("quantity", 0),
+                price=item["price"],
+                price_rrc=item["price_rrc"],
+                fingerprint=fingerprints[external_id],
             )
+            for external_id, item in by_external_id.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["shop", "external_id"],
+        update_fields=PRODUCT_INFO_FIELDS,
+    )
+    info_ids = dict(
+        ProductInfo.objects.filter(shop=shop, external_id__in=by_external_id).values_list("external_id", "id")
+    )
+    goods_by_info = {info_ids[external_id]: item for external_id, item in by_external_id.items()}
+
+    param_names = {name for item in changed for name in item.get("parameters", {})}
+    parameters = resolve_parameters(param_names) if param_names else {}
+    stats["parameters"], stats["removed"] = sync_parameters(list(goods_by_info), goods_by_info, parameters)
+    refresh_catalog_entries(goods_by_info)
+    stats["goods"] = len(by_external_id)
+    return stats
+
+
+def prepare_shared_rows(feed, batch_size=BATCH_SIZE):
+    """
+    Первый проход по прайсу: создаёт недостающие категории, продукты и
+    характеристики короткой транзакцией на пачку, до транзакции импорта
+    магазина. Так импорты новых магазинов не ждут друг друга до коммита.
+    Товары неизвестных категорий пропускаются: ошибку сообщит импорт.
+    """
+    batch = []
+
+    def flush():
+        with transaction.atomic():
+            categories = {item["category"] for item in batch}
+            existing = set(Category.objects.filter(id__in=categories).values_list("id", flat=True))
+            goods = [item for item in batch if item["category"] in existing]
+            if goods:
+                resolve_products(goods)
+            names = {name for item in goods for name in item.get("parameters", {})}
+            if names:
+                resolve_parameters(names)
+        batch.clear()
+
+    for key, value in iter_feed(feed):
+        if key == "categories" and value:
+            with transaction.atomic():
+                create_categories(value)
+        elif key == "goods" and value is not None:
+            batch.append(value)
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+
+
+@contextmanager
+def seekable(stream):
+    """Поток, который можно прочитать дважды: ответ HTTP копируется во временный файл"""
+    if getattr(stream, "seekable", lambda: False)():
+        yield stream
+        return
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool)
+        spool.seek(0)
+        yield spool
+
+
+def get_shop(name, user=None):
+    """Находит магазин по названию; чужой магазин партнёру не отдаётся"""
+    shop, _ = Shop.objects.get_or_create(name=name, defaults={"user": user})
+    if user is not None and shop.user_id != user.id:
+        if shop.user_id is not None:
+            raise ValueError(f"Магазин '{name}' принадлежит другому пользователю")
+        shop.user = user
+        shop.save(update_fields=["user"])
+    return shop
+
+
+def import_shop_from_stream(stream, batch_size=BATCH_SIZE, full=False, user=None, progress=None):
+    """
+    Импортирует прайс из потока, не загружая документ целиком.
+
+    Прайс читается дважды: сначала общие строки каталога создаются
+    отдельными короткими транзакциями (prepare_shared_rows), затем товары
+    магазина записываются одной транзакцией (import_shop_goods).
+    """
+    with seekable(stream) as feed:
+        start = feed.tell()
+        prepare_shared_rows(feed, batch_size)
+        feed.seek(start)
+        return import_shop_goods(feed, batch_size=batch_size, full=full, user=user, progress=progress)
+
+
+@transaction.atomic
+def import_shop_goods(stream, batch_size=BATCH_SIZE, full=False, user=None, progress=None):
+    """
+    Записывает товары магазина из прайса одной транзакцией.
+
+    Товары читаются по одному и копятся в пачку из batch_size штук,
+    поэтому расход памяти не зависит от размера прайса. Неизменившиеся
+    товары пропускаются, если не передан full=True. После каждой пачки
+    вызывается progress(stats), если он передан.
+
+    Потоком обрабатываются прайсы с порядком секций shop, categories, goods.
+    Товары, пришедшие раньше shop или categories (или в прайсе без
+    categories), ждут в памяти, пока обе секции не станут известны.
+    """
+    shop = None
+    categories = None  # None - секция ещё не встречалась
+    known_categories = set()
+    pending = []
+    batch = []
+    stats = {
+        "shop": None, "categories": 0, "parsed": 0,
+        "goods": 0, "unchanged": 0, "parameters": 0, "removed": 0,
+    }
+
+    def flush():
+        for key, value in import_goods_batch(shop, batch, known_categories, full=full).items():
+            stats[key] += value
+        batch.clear()
+        if progress is not None:
+            progress(stats)
+
+    def add(items):
+        nonlocal categories
+        if categories:
+            # 2. Создаём категории и связываем с магазином
+            import_categories(shop, categories)
+            known_categories.update(cat["id"] for cat in categories)
+            stats["categories"] += len(categories)
+            categories = []
+        # 3. Обрабатываем товары пачками: число запросов растёт с числом пачек, а не товаров
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+
+    for key, value in iter_feed(stream):
+        if key == "shop":
+            # 1. Создаём магазин
+            shop = get_shop(value, user)
+            stats["shop"] = shop.name
+        elif key == "categories":
+            categories = value or []
+        elif key == "goods" and value is not None:
+            stats["parsed"] += 1
+            pending.append(value)
+        if shop is not None and categories is not None and pending:
+            add(pending)
+            pending.clear()
+
+    if shop is None:
+        raise ValueError("В прайсе не указан магазин")
+    if categories is None:
+        categories = []
+    add(pending)
+    if batch:
+        flush()
+    if stats["goods"] or stats["removed"]:
+        refresh_facets(known_categories | set(shop.categories.values_list("id", flat=True)))
+        bump_catalog_version([shop.id])
 
     print(f"Импорт магазина '{shop.name}' завершён успешно.")
+    return stats
+
 
+def import_shop_from_yaml(yaml_path, batch_size=BATCH_SIZE, full=False):
+    with open(yaml_path, "rb") as f:
+        return import_shop_from_stream(f, batch_size=batch_size, full=full)
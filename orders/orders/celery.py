@@ -0,0 +1,19 @@
+"""
+Celery-приложение проекта.
+
+Воркер запускается из каталога orders:
+    celery -A orders worker -l info
+
+Периодическая отправка очереди писем (CELERY_BEAT_SCHEDULE):
+    celery -A orders beat -l info
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+
+app = Celery('orders')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
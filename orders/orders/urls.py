@@ -17,21 +17,30 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.views.generic.base import RedirectView
-from backend.views import RegisterView, LoginView, ProductListView, BasketView, BasketAddView, BasketRemoveView, ContactView, ContactAddView, ContactRemoveView, ConfirmOrderView, OrderListView
+from backend.middleware import metrics_view
+from backend.views import RegisterView, LoginView, ProductListView, ProductFacetView, ProductSearchView, BasketView, BasketAddView, BasketBatchView, BasketRemoveView, ContactView, ContactAddView, ContactRemoveView, ConfirmOrderView, OrderListView, PartnerUpdateView, ImportJobView, PartnerOrderStateView, PartnerOrdersView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
     path('products/', ProductListView.as_view(), name='product-list'),
+    path('products/facets/', ProductFacetView.as_view(), name='product-facets'),
+    path('products/search/', ProductSearchView.as_view(), name='product-search'),
     path('basket/', BasketView.as_view(), name='basket'),
     path('basket/add/', BasketAddView.as_view(), name='basket-add'),
+    path('basket/batch/', BasketBatchView.as_view(), name='basket-batch'),
     path('basket/remove/', BasketRemoveView.as_view(), name='basket-remove'),
     path('contacts/', ContactView.as_view(), name='contacts'),
     path('contacts/add/', ContactAddView.as_view(), name='contacts-add'),
     path('contacts/remove/<int:pk>/', ContactRemoveView.as_view(), name='contacts-remove'),
     path('order/confirm/', ConfirmOrderView.as_view(), name='confirm-order'),
     path('orders/', OrderListView.as_view(), name='order-list'),
+    path('partner/update/', PartnerUpdateView.as_view(), name='partner-update'),
+    path('partner/update/<int:pk>/', ImportJobView.as_view(), name='partner-update-status'),
+    path('partner/orders/', PartnerOrdersView.as_view(), name='partner-orders'),
+    path('partner/orders/state/', PartnerOrderStateView.as_view(), name='partner-order-state'),
+    path('metrics/', metrics_view, name='metrics'),
     path("", RedirectView.as_view(url="/products/", permanent=False)),
 
 ]